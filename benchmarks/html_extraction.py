@@ -0,0 +1,71 @@
+"""Compare `extract_image_hrefs` with the former BeautifulSoup (html5lib) extraction.
+
+Pass saved album pages (e.g. `driver.page_source` written to a file) as arguments. Without
+arguments, the pages in `benchmarks/fixtures` (trimmed album markup, to check that both
+extractions agree on real pages) and a synthetic page with a few thousand links are used.
+
+Usage (from the repository root):
+    python -m benchmarks.html_extraction [page.html ...]
+"""
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+from rtl2_horoscope.scraper.facebook import extract_image_hrefs
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def synthetic_page(n=3000):
+    items = "\n".join(
+        f'<div class="item"><a href="/photo/{i}"><div><img src="https://scontent.example/{i % 2000}.jpg?a=1&amp;b=2" alt=""></div></a>'
+        f'<span><img src="https://static.example/icon{i}.png"></span></div>'
+        for i in range(n)
+    )
+    return f"<!DOCTYPE html><html><head><title>Album</title></head><body>{items}</body></html>"
+
+
+def soup_hrefs(page_source):
+    soup = BeautifulSoup(page_source, features="html5lib")
+    hrefs = []
+    for a in soup.find_all("a"):
+        for img in a.find_all("img"):
+            hrefs.append(img["src"])
+    # Same order, without duplicates
+    return list(dict.fromkeys(hrefs))
+
+
+def measure(func, page_source):
+    tracemalloc.start()
+    start = time.perf_counter()
+    out = func(page_source)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return out, elapsed, peak / 2**20
+
+
+def main(paths):
+    if paths:
+        pages = {path: open(path, encoding="utf8").read() for path in paths}
+    else:
+        pages = {path.name: path.read_text(encoding="utf8") for path in sorted(FIXTURES.glob("*.html"))}
+        pages["synthetic"] = synthetic_page()
+    errors = 0
+
+    print(f"{'page':<30} {'hrefs':>6} {'soup s':>7} {'soup MB':>8} {'parser s':>8} {'parser MB':>9} {'same':>5}")
+    for name, page_source in pages.items():
+        expected, t_soup, m_soup = measure(soup_hrefs, page_source)
+        hrefs, t_parser, m_parser = measure(extract_image_hrefs, page_source)
+        same = hrefs == expected
+        errors += not same
+        print(f"{name:<30} {len(hrefs):>6} {t_soup:>7.2f} {m_soup:>8.1f} {t_parser:>8.2f} {m_parser:>9.1f} {same!s:>5}")
+
+    return errors
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main(sys.argv[1:]) else 0)
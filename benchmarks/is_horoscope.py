@@ -0,0 +1,60 @@
+"""Compare the tiered `Scraper.is_horoscope` with the full-header KMeans classification.
+
+Horoscopes are the images in examples/, non-horoscopes are the same images flipped upside down
+(right size, wrong header) and converted to grayscale.
+
+Usage (from the repository root):
+    python -m benchmarks.is_horoscope
+"""
+import io
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image, ImageOps
+
+from rtl2_horoscope.scraper import Scraper
+
+
+def candidates():
+    for path in sorted(Path("examples").glob("photo*.jpg")):
+        img = Image.open(path).convert("RGB")
+        yield path.name, True, img
+        yield path.name + " (flipped)", False, ImageOps.flip(img)
+        yield path.name + " (gray)", False, ImageOps.grayscale(img).convert("RGB")
+
+
+def to_jpeg(img):
+    fp = io.BytesIO()
+    img.save(fp, format="JPEG")
+    return fp
+
+
+def timed(func, *args, repeat=5, **kwargs):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = func(*args, **kwargs)
+    return out, (time.perf_counter() - start) / repeat
+
+
+def main():
+    scraper = Scraper("benchmark")
+    errors = 0
+    total_full, total_tiered = 0, 0
+
+    print(f"{'image':<28} {'expected':>8} {'full':>6} {'tiered':>6} {'full ms':>8} {'tiered ms':>9}")
+    for name, expected, img in candidates():
+        fp = to_jpeg(img)
+        full, t_full = timed(scraper.is_horoscope, fp, stride=1)
+        tiered, t_tiered = timed(scraper.is_horoscope, fp)
+        total_full += t_full
+        total_tiered += t_tiered
+        errors += (full != expected) + (tiered != full)
+        print(f"{name:<28} {expected!s:>8} {full!s:>6} {tiered!s:>6} {1000*t_full:>8.1f} {1000*t_tiered:>9.1f}")
+
+    print(f"Speedup: x{total_full/total_tiered:.1f}, mismatches: {errors}")
+    return errors
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main() else 0)
@@ -0,0 +1,59 @@
+"""Compare OCR speed and accuracy with and without `preprocess_crop` and the character whitelist.
+
+Accuracy is measured against the expected output of the `parse_horoscope` doctest
+(examples/photo103.jpg), as the mean similarity (difflib ratio) of each sign's text.
+
+Usage (from the repository root):
+    python -m benchmarks.ocr_preprocessing [--repeat 3]
+"""
+import argparse
+import ast
+import difflib
+import doctest
+import time
+
+from rtl2_horoscope.ocr import default_pool
+from rtl2_horoscope.parse import parse_horoscope, whitelist_pool
+
+CONFIGS = {
+    "raw crops": dict(pool=default_pool, preprocess=False),
+    "preprocessed": dict(pool=default_pool, preprocess=True),
+    "preprocessed + whitelist": dict(pool=whitelist_pool, preprocess=True),
+}
+
+
+def expected_output():
+    example = doctest.DocTestParser().get_examples(parse_horoscope.__doc__)[0]
+    return example.source, ast.literal_eval(example.want)
+
+
+def similarity(horoscope, expected):
+    ratios = [
+        difflib.SequenceMatcher(None, horoscope[sign][1], text).ratio()
+        for sign, (_, text) in expected.items()
+    ]
+    return sum(ratios) / len(ratios)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    source, expected = expected_output()
+    path = ast.literal_eval(source.split("(", 1)[1].split(",", 1)[0])
+
+    print(f"{'configuration':<28} {'ms/image':>9} {'similarity':>11} {'exact texts':>12}")
+    for name, config in CONFIGS.items():
+        parse_horoscope(path, threads=1, verbose=False, **config)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            horoscope = parse_horoscope(path, threads=1, verbose=False, **config)
+        elapsed = (time.perf_counter() - start) / args.repeat
+        exact = sum(horoscope[sign][1] == text for sign, (_, text) in expected.items())
+        print(f"{name:<28} {1000*elapsed:>9.0f} {similarity(horoscope, expected):>11.3f} "
+              f"{exact:>9}/{len(expected)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Time each stage of the horoscope pipeline over examples/photo*.jpg.
+
+Every stage runs in a fresh process, so that its peak RSS is its own. For each stage, the wall
+time and CPU time (including child processes, e.g. tesseract) per image are averaged over
+`--repeat` runs, after one warm-up run which also loads the models.
+
+Results are compared to a JSON baseline, and stages slower than the baseline by more than
+`--threshold` are reported as regressions (exit code 1). Use `--save` to write a new baseline.
+
+Usage (from the repository root):
+    python -m benchmarks.pipeline [--save] [--baseline benchmarks/baseline.json] [--stages ...]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from pathlib import Path
+
+BASELINE_PATH = "benchmarks/baseline.json"
+
+
+def _open_all(paths):
+    from PIL import Image
+
+    images = [Image.open(path).convert("RGB") for path in paths]
+    for img in images:
+        img.load()
+    return images
+
+
+# Each stage prepares its inputs (outside of the timings) and returns the function to time
+
+
+def _parse(threads):
+    def prepare(paths):
+        from rtl2_horoscope.parse import parse_horoscope
+
+        return lambda: [parse_horoscope(path, threads=threads, verbose=False) for path in paths]
+    return prepare
+
+
+def _align(paths):
+    from rtl2_horoscope.parse import align_regions
+
+    images = _open_all(paths)
+    return lambda: [align_regions(img) for img in images]
+
+
+def _stars(robust):
+    def prepare(paths):
+        import numpy as np
+        from rtl2_horoscope.parse import find_star_colors, regions_for_size
+
+        inputs = [(np.asarray(img), regions_for_size(*img.size)) for img in _open_all(paths)]
+        return lambda: [find_star_colors(pixels, robust=robust, regions=regions) for pixels, regions in inputs]
+    return prepare
+
+
+def _texts(threads):
+    def prepare(paths):
+        import numpy as np
+        from rtl2_horoscope.parse import read_texts, regions_for_size
+
+        inputs = [(np.asarray(img), regions_for_size(*img.size)) for img in _open_all(paths)]
+        return lambda: [
+            read_texts(pixels, threads=threads, regions=regions, verbose=False) for pixels, regions in inputs
+        ]
+    return prepare
+
+
+def _scraper(method):
+    def prepare(paths):
+        from rtl2_horoscope.scraper import Scraper
+
+        scraper = Scraper("benchmark")
+        return lambda: [getattr(scraper, method)(path) for path in paths]
+    return prepare
+
+
+STAGES = {
+    "parse_horoscope (threads=1)": _parse(1),
+    "parse_horoscope (threads=12)": _parse(12),
+    "align_regions": _align,
+    "find_star_colors (robust)": _stars(True),
+    "find_star_colors (fast)": _stars(False),
+    "read_texts (threads=1)": _texts(1),
+    "read_texts (threads=4)": _texts(4),
+    "read_texts (threads=12)": _texts(12),
+    "is_horoscope": _scraper("is_horoscope"),
+    "is_horoscope_of_the_day": _scraper("is_horoscope_of_the_day"),
+}
+
+
+def _cpu_time():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def _run_stage(name, paths, repeat, queue):
+    stage = STAGES[name](paths)
+    stage()
+
+    wall, cpu = time.perf_counter(), _cpu_time()
+    for _ in range(repeat):
+        stage()
+    n = repeat * len(paths)
+    queue.put({
+        "wall_ms": 1000 * (time.perf_counter() - wall) / n,
+        "cpu_ms": 1000 * (_cpu_time() - cpu) / n,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def measure(name, paths, repeat=3):
+    """Run a stage in a fresh process and return its timings per image and its peak RSS."""
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_stage, args=(name, paths, repeat, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Stage {name!r} failed")
+    return queue.get()
+
+
+def compare(results, baseline, threshold):
+    """Return the names of the stages slower than the baseline by more than `threshold`."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ["wall_ms", "cpu_ms", "peak_rss_mb"]:
+            if result[key] > baseline[name][key] * (1 + threshold):
+                regressions.append(f"{name}: {key} {baseline[name][key]:.1f} -> {result[key]:.1f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Relative slowdown reported as a regression. Default: 0.2.")
+    parser.add_argument("--save", action="store_true", help="Save the results as the new baseline.")
+    args = parser.parse_args()
+
+    paths = [str(path) for path in sorted(Path("examples").glob("photo*.jpg"))]
+
+    results = {}
+    print(f"{'stage':<32} {'wall ms':>8} {'cpu ms':>8} {'peak RSS MB':>12}")
+    for name in args.stages:
+        results[name] = measure(name, paths, args.repeat)
+        print(f"{name:<32} {results[name]['wall_ms']:>8.1f} {results[name]['cpu_ms']:>8.1f} "
+              f"{results[name]['peak_rss_mb']:>12.0f}")
+
+    if args.save:
+        baseline = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+        baseline.update(results)
+        with open(args.baseline, "w") as file:
+            json.dump(baseline, file, indent=4)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save to create it")
+        return 0
+
+    with open(args.baseline) as file:
+        regressions = compare(results, json.load(file), args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+"""Measure import time of the bot modules and first-use load time of the models.
+
+Each measure runs in a fresh interpreter, so that nothing is already imported or loaded.
+
+Usage (from the repository root):
+    python -m benchmarks.startup
+"""
+import subprocess
+import sys
+
+MEASURES = {
+    "import rtl2_horoscope.parse": "import rtl2_horoscope.parse",
+    "import rtl2_horoscope.scraper.facebook": "import rtl2_horoscope.scraper.facebook",
+    "FacebookScraper()": (
+        "from rtl2_horoscope.scraper.facebook import FacebookScraper\n"
+        "FacebookScraper()"
+    ),
+    "first kmeans_lut()": (
+        "from rtl2_horoscope.scraper.scraper import kmeans_lut\n"
+        "kmeans_lut()"
+    ),
+    "first ocr_model()": (
+        "from rtl2_horoscope.ocr import ocr_model\n"
+        "ocr_model()"
+    ),
+}
+
+TEMPLATE = """
+import resource, time
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def measure(code):
+    out = subprocess.run(
+        [sys.executable, "-c", TEMPLATE.format(code=code)],
+        capture_output=True, text=True, check=True,
+    )
+    elapsed, max_rss = out.stdout.split()[-2:]
+    return float(elapsed), int(max_rss) / 1024
+
+
+def main():
+    print(f"{'measure':<40} {'seconds':>8} {'peak RSS (MB)':>14}")
+    for name, code in MEASURES.items():
+        elapsed, max_rss = measure(code)
+        print(f"{name:<40} {elapsed:>8.2f} {max_rss:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
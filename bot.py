@@ -5,7 +5,6 @@ import asyncio
 import re
 import os
 import pickle
-import datetime as dt
 
 logging.basicConfig(
     level=logging.INFO,
@@ -16,9 +15,16 @@ from PIL import Image
 from typing import Optional, List
 
 from my_constants import TOKEN, IMG_FOLDER, channel_horoscope
+from rtl2_horoscope.scraper.composite import CompositeScraper
 from rtl2_horoscope.scraper.facebook import FacebookScraper
-from rtl2_horoscope.parse import parse_horoscope, reformat_horoscope
-from rtl2_horoscope.utils import now
+from rtl2_horoscope.scraper.twitter import TwitterScraper
+from rtl2_horoscope.archive import HoroscopeArchive
+from rtl2_horoscope.cache import HoroscopeCache
+from rtl2_horoscope.jobs import JobRunner
+from rtl2_horoscope.metrics import metrics
+from rtl2_horoscope.ocr import doctr_engine
+from rtl2_horoscope.parse import reformat_horoscope, star_emojis
+from rtl2_horoscope.schedule import FetchScheduler, learn_publication_time
 
 #import nest_asyncio
 #nest_asyncio.apply()
@@ -29,6 +35,10 @@ manual  = """
 <@{id}> test  -- Récupère la dernière photo de RTL2 (horoscope ou pas)
 <@{id}> last  -- Donne le dernier horoscope de RTL2
 <@{id}> download  <URL> -- Télécharge l'image via l'URL donnée en argument et vérifie s'il s'agit de l'horoscope de RTL2
+<@{id}> stats -- Durées récentes (ms) de chaque étape et compteurs d'images
+<@{id}> history <signe> -- Derniers horoscopes d'un signe
+<@{id}> date <AAAA-MM-JJ> -- Horoscope d'un jour donné
+<@{id}> search <mots> -- Horoscopes contenant tous les mots donnés
 ```
 """
 
@@ -38,11 +48,20 @@ TIMESTAMP_FORMAT = "%Y-%m-%d"
 class HoroscopeDiscordBot(discord.Client):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.scraper = FacebookScraper()
+        # Look for the horoscope on both social media at once, the first one to publish it wins
+        self.scraper = CompositeScraper([FacebookScraper(), TwitterScraper()])
+        self.cache = HoroscopeCache()
+        self.archive = HoroscopeArchive()
+        self.jobs = JobRunner()
+        self.scheduler = FetchScheduler(
+            self.fetch_new_horoscope,
+            learn_usual_time=lambda: learn_publication_time(IMG_FOLDER),
+        )
+        self.job_task = None
 
     async def setup_hook(self):
         # create the background task and run it in the background
-        self.loop.create_task(self.job())
+        self.job_task = self.loop.create_task(self.job())
 
     async def on_ready(self):
         """Initial check"""
@@ -71,40 +90,10 @@ class HoroscopeDiscordBot(discord.Client):
         """
         return re.match(f"^<@!?{self.user.id}> {cmd}", message.content)
 
-    async def job(self, fetch_interval=300, days=[0,1,2,3,4], hours=[9,10,11,12]):
-        """ Job to run evey `fetch_interval` seconds,
-        each day in days, between hours
-        Args:
-            fetch_interval (int) : run job every `fetch_interval` seconds
-            days (list of int): day to fetch horoscope
-            hours (list of hour) : (whole) hour to fetch horoscope
-
-        Example : job(300, [0,1,3,4], [7,8,10,12,13]):
-        Run the job on Monday, Tuesday, Thursday and Friday, between 7 and 8 hours
-        and between 10 and 13 hours.
-        """
+    async def job(self):
+        """Poll for the horoscope of the day, see `FetchScheduler` for the fetch windows."""
         await self.wait_until_ready()
-
-        assert max(days) <= 6, "Need number between 0 and 6"
-        assert min(days) >= 0, "Need number between 0 and 6"
-
-        assert max(hours) <= 23, "Need number between 0 and 23"
-        assert min(hours) >= 0, "Need number between 0 and 23"
-
-        while not self.is_closed():
-            today = now()
-
-            while today.weekday() in days and today.hour in hours \
-                and not await self.fetch_new_horoscope():
-                # while (it's time to fetch horoscope) AND (the horoscope has not been published yet)
-                # wait fetch_interval to not spam Twitter
-                await asyncio.sleep(fetch_interval)
-
-            time_to_wait = self.get_time_to_wait(hours).total_seconds()
-            time_to_wait_message = f"Reprise de l'activité dans {time_to_wait} secondes."
-            logging.info(time_to_wait_message)
-
-            await asyncio.sleep(time_to_wait)
+        await self.scheduler.run()
 
     async def on_message(self, message):
         """Handle messages
@@ -119,12 +108,47 @@ class HoroscopeDiscordBot(discord.Client):
         if self.command(message, "download"):
             img_href = message.content.split(" ")[-1]
             if img_href.startswith("http") and await self.fetch_new_horoscope(img_href=img_href):
-                time_to_wait = self.get_time_to_wait([10,11,12]).total_seconds()
-                time_to_wait_message = f"Reprise de l'activité dans {time_to_wait} secondes."
-                logging.info(time_to_wait_message)
-                await asyncio.sleep(time_to_wait)
+                # No need to look for today's horoscope anymore
+                self.scheduler.mark_done()
+
+        if self.command(message, "stats"):
+            await self.get_channel(channel_horoscope).send(f"```\n{metrics.summary()}\n```")
+
+        if self.command(message, "history"):
+            sign = message.content.split(" ", 2)[-1]
+            rows = self.archive.history(sign, limit=5)
+            if not rows:
+                await self.get_channel(channel_horoscope).send(f"Aucun horoscope pour le signe {sign}.")
+                return
+            await self.get_channel(channel_horoscope).send("\n".join(
+                f"- **{date}** {star_emojis[star]}: {text}" for date, star, text in rows
+            ))
+
+        if self.command(message, "date"):
+            date = message.content.split(" ")[-1]
+            horoscope_dict = self.archive.by_date(date)
+            if not horoscope_dict:
+                await self.get_channel(channel_horoscope).send(f"Aucun horoscope pour le {date}.")
+                return
+            await self.get_channel(channel_horoscope).send(reformat_horoscope(horoscope_dict))
+
+        if self.command(message, "search"):
+            words = message.content.split(" ", 2)[-1]
+            rows = self.archive.search(words, limit=5)
+            if not rows:
+                await self.get_channel(channel_horoscope).send("Aucun horoscope ne correspond.")
+                return
+            await self.get_channel(channel_horoscope).send("\n".join(
+                f"- **{date} {sign.title()}** {star_emojis[star]}: {text}" for date, sign, star, text in rows
+            ))
 
         if self.command(message, "last"):
+            latest = self.archive.latest()
+            if latest is not None and latest[1] is not None and os.path.isfile(latest[1]):
+                # Answer from the archive, without listing the folder nor running OCR again
+                date, horoscope_img = latest
+                await self.send_horoscope(horoscope_img, self.archive.by_date(date))
+                return
             files = sorted(os.listdir(IMG_FOLDER), reverse=True)
             if len(files) == 0:
                 await self.get_channel(channel_horoscope).send("Aucun horoscope en stock :-(")
@@ -132,14 +156,36 @@ class HoroscopeDiscordBot(discord.Client):
             horoscope_img = IMG_FOLDER + "/" + files[0]
             await self.parse_and_send_horoscope(horoscope_img)
 
+    async def close(self):
+        self.scheduler.stop()
+        if self.job_task is not None:
+            self.job_task.cancel()
+        await super().close()
+        self.jobs.shutdown()
+        self.scraper.close()
+
     async def parse_and_send_horoscope(self, filename):
         """Parse the image and send the image and the text found through OCR"""
         logging.info("OCR : en cours.")
-        horoscope_dict = parse_horoscope(filename, threads=1)
-        horoscope_str = reformat_horoscope(horoscope_dict)
+        try:
+            # Parse in a worker thread, concurrent requests for the same image share the result.
+            # The doctr model is already loaded for the scraper: use it on doubtful text blocks.
+            horoscope_dict = await self.jobs.run(
+                os.path.abspath(filename), self.cache.parse_horoscope, filename, verbose=False,
+                fallback=doctr_engine,
+            )
+        except asyncio.QueueFull:
+            logging.info("OCR : trop de demandes en cours.")
+            await self.get_channel(channel_horoscope).send("Trop de demandes en cours, réessayez plus tard.")
+            return
         logging.info("OCR : terminé.")
+        self.archive.add_file(filename, horoscope_dict)
+        await self.send_horoscope(filename, horoscope_dict)
+
+    async def send_horoscope(self, filename, horoscope_dict):
+        """Send the image and the text of a horoscope"""
         await self.get_channel(channel_horoscope).send(file=discord.File(filename))
-        await self.get_channel(channel_horoscope).send(horoscope_str)
+        await self.get_channel(channel_horoscope).send(reformat_horoscope(horoscope_dict))
 
     async def fetch_new_horoscope(self, img_href: Optional[str] = None) -> bool:
         """Get last image from RTL2 social media page, check if it's a new horoscope
@@ -147,29 +193,16 @@ class HoroscopeDiscordBot(discord.Client):
         Args:
             img_href : if not None, download the image from <img_href> url
         """
-        horoscope = await self.scraper.fetch_new_horoscope(img_href)
+        try:
+            with metrics.timer("fetch"):
+                horoscope = await self.scraper.fetch_new_horoscope(img_href)
+        finally:
+            metrics.write_prometheus()
         if horoscope:
             await self.parse_and_send_horoscope(horoscope)
             return True
         return False
 
-    def get_time_to_wait(self, hours):
-        """How many time to wait before checking
-        for a new horoscope ?
-        """
-
-        today = now()
-        # Wait until tomorrow
-        days_to_wait = 1
-        if today.weekday() == 4:
-            # it's Friday -> wait two more days
-            days_to_wait += 2
-        if today.weekday() == 5:
-            # it's Saturday -> wait one more day
-            days_to_wait += 1
-        next_day = today.replace(hour=hours[0],minute=0,second=0,microsecond=0) + dt.timedelta(days=days_to_wait)
-        return next_day-today
-
 if __name__ == "__main__":
     intents = discord.Intents.default()
     intents.message_content = True
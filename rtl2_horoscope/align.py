@@ -0,0 +1,172 @@
+import logging
+import threading
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image
+
+
+class Transform(NamedTuple):
+    """Mapping from template coordinates to image coordinates: x_image = scale * x_template + dx."""
+    scale: float
+    dx: int
+    dy: int
+
+    def apply(self, box):
+        """Map a (left, upper, right, lower) box of the template to integer image coordinates."""
+        left, upper, right, lower = box
+        return (
+            round(left*self.scale + self.dx), round(upper*self.scale + self.dy),
+            round(right*self.scale + self.dx), round(lower*self.scale + self.dy),
+        )
+
+
+def _grayscale(img, width):
+    """Image resized to `width` (keeping its aspect ratio), as a float grayscale array."""
+    img = img.convert("L")
+    # Integer reduction first: cheap, and keeps the final (bilinear) resize small
+    factor = img.width // (2*width)
+    if factor > 1:
+        img = img.reduce(factor)
+    height = max(1, round(img.height * width / img.width))
+    return np.asarray(img.resize((width, height), Image.BILINEAR), dtype=np.float32)
+
+
+def _fit(array, shape):
+    """Crop or pad (with the mean) `array` to `shape`, keeping its top left corner in place."""
+    out = np.full(shape, array.mean(), dtype=np.float32)
+    h, w = min(shape[0], array.shape[0]), min(shape[1], array.shape[1])
+    out[:h, :w] = array[:h, :w]
+    return out
+
+
+def _subpixel(values, i):
+    """Parabolic interpolation of the peak of `values` (circular) around index `i`."""
+    left, center, right = values[i - 1], values[i], values[(i + 1) % len(values)]
+    denominator = left - 2*center + right
+    return i + (0.5 * (left - right) / denominator if denominator != 0 else 0)
+
+
+class Aligner:
+    """Register horoscope images on a reference horoscope by phase correlation.
+
+    The reference and the image are compared in grayscale at a low resolution: for a candidate
+    scale, the translation is the peak of their normalized cross-power spectrum, and the scale
+    with the highest peak wins. The layout (sign labels, boxes, stars and header) is the same
+    every day, so it dominates the correlation over the texts. Candidate scales are first
+    compared at half `work_width`, then the best one is refined at `work_width`.
+
+    Args:
+        reference (str or PIL.Image): Horoscope aligned with the template, i.e. a uniform scale of it.
+        template_size (tuple of ints): Size of the template in which regions are defined.
+        work_width (int): Width of the images compared, in pixels.
+            Default: 256.
+        scales (sequence of floats): Candidate scales, relative to the one given by the image width.
+            Default: 0.95 to 1.05 by steps of 1%.
+        min_peak (float): Correlation peak (between 0 and 1) below which the image is
+            considered not aligned with the reference, and only scaled from its width.
+            Default: 0.05.
+        max_shift (float): Largest translation accepted, as a fraction of the image size.
+            Default: 0.1.
+    """
+
+    def __init__(self, reference, template_size, work_width=256, scales=np.linspace(0.95, 1.05, 11),
+                 min_peak=0.05, max_shift=0.1):
+        self.reference = reference
+        self.template_width, self.template_height = template_size
+        self.work_width = work_width
+        self.scales = np.asarray(scales)
+        self.min_peak = min_peak
+        self.max_shift = max_shift
+        self._spectra = {}
+        self._lock = threading.Lock()
+
+    def _shape(self, width):
+        """Shape of the arrays compared at `width`: the template at this width."""
+        return round(self.template_height * width / self.template_width), width
+
+    def _spectrum(self, width):
+        """Hann window and windowed spectrum of the reference at `width`, computed on first use."""
+        with self._lock:
+            if width not in self._spectra:
+                reference = self.reference
+                if not isinstance(reference, Image.Image):
+                    reference = Image.open(reference)
+                shape = self._shape(width)
+                window = np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+                array = _fit(_grayscale(reference, width), shape)
+                self._spectra[width] = window, np.fft.rfft2((array - array.mean()) * window)
+            return self._spectra[width]
+
+    def correlate(self, array, width):
+        """Phase correlation of `array` with the reference, both at `width`.
+
+        Returns:
+            (float, float, float): Peak value, and (dy, dx) translation of the reference (in pixels
+                at `width`) for it to match `array`.
+        """
+        window, reference = self._spectrum(width)
+        shape = self._shape(width)
+        array = _fit(array, shape)
+        cross = np.fft.rfft2((array - array.mean()) * window) * np.conj(reference)
+        correlation = np.fft.irfft2(cross / (np.abs(cross) + 1e-9), s=shape)
+
+        i, j = np.unravel_index(np.argmax(correlation), shape)
+        dy = _subpixel(correlation[:, j], i)
+        dx = _subpixel(correlation[i, :], j)
+        # Shifts are circular: beyond half the size, they are negative
+        height, width = shape
+        dy = dy - height if dy > height / 2 else dy
+        dx = dx - width if dx > width / 2 else dx
+        return correlation[i, j], dy, dx
+
+    def _search(self, base, width, scales):
+        """Correlate `base` resized for each candidate scale, return the peaks and translations."""
+        results = []
+        for scale in scales:
+            # At the resolution of the reference, the image is resized by 1/scale to match it
+            resized_width = round(width / scale)
+            resized_height = round(base.height * resized_width / base.width)
+            array = np.asarray(base.resize((resized_width, resized_height), Image.BILINEAR), dtype=np.float32)
+            results.append(self.correlate(array, width))
+        return results
+
+    def transform(self, img):
+        """Compute the template -> image transform of a horoscope.
+
+        Args:
+            img (PIL.Image): Horoscope image.
+
+        Returns:
+            Transform: Scale and translation to apply to the template regions. Only scaled from
+                the image width if no candidate correlates well enough with the reference.
+        """
+        nominal = img.width / self.template_width
+        fallback = Transform(nominal, 0, 0)
+
+        # Image at the resolution of the reference for the smallest candidate scale, the other
+        # candidates are resized from it
+        base = Image.fromarray(_grayscale(img, round(self.work_width / self.scales.min())))
+
+        # Coarse search over all candidate scales
+        coarse = self._search(base, self.work_width // 2, self.scales)
+        k = int(np.argmax([peak for peak, _, _ in coarse]))
+
+        # Fine search around the best one, by half steps
+        step = np.diff(self.scales).mean() / 2 if len(self.scales) > 1 else 0
+        scales = self.scales[k] + np.array([-step, 0, step])
+        fine = self._search(base, self.work_width, scales)
+        k = int(np.argmax([peak for peak, _, _ in fine]))
+        peak, dy, dx = fine[k]
+        scale = scales[k]
+
+        # Pixels at work_width -> image pixels
+        scale = nominal * scale
+        factor = scale * self.template_width / self.work_width
+        dx, dy = dx * factor, dy * factor
+        if peak < self.min_peak or abs(dx) > self.max_shift * img.width or abs(dy) > self.max_shift * img.height:
+            logging.debug(f"Alignement rejeté (pic {peak:.3f}, décalage {dx:.0f}, {dy:.0f})")
+            return fallback
+
+        logging.debug(f"Alignement : échelle {scale:.4f}, décalage {dx:.1f}, {dy:.1f} (pic {peak:.3f})")
+        return Transform(float(scale), round(dx), round(dy))
@@ -0,0 +1,118 @@
+import re
+import unicodedata
+from pathlib import Path
+
+from rtl2_horoscope.utils import sqlite_connection
+
+ARCHIVE_PATH = "horoscope_archive.sqlite"
+
+
+def normalize_sign(sign):
+    """Lowercase a zodiac sign and remove its accents, e.g. "Bélier" -> "belier"."""
+    sign = unicodedata.normalize("NFKD", sign.strip().lower())
+    return "".join(c for c in sign if not unicodedata.combining(c))
+
+
+class HoroscopeArchive:
+    """Indexed store of parsed horoscopes, to answer history queries without touching images.
+
+    Texts are indexed with SQLite FTS5 (case and accent insensitive), and horoscopes are indexed
+    by date, sign and star color.
+
+    Args:
+        path (str): SQLite database file.
+            Default: ARCHIVE_PATH.
+    """
+
+    def __init__(self, path=ARCHIVE_PATH):
+        self.path = path
+        with sqlite_connection(self.path) as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS horoscopes ("
+                "date TEXT NOT NULL, sign TEXT NOT NULL, star TEXT, text TEXT, path TEXT, "
+                "PRIMARY KEY (date, sign))"
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS horoscopes_sign ON horoscopes (sign, date)")
+            con.execute("CREATE INDEX IF NOT EXISTS horoscopes_star ON horoscopes (star, date)")
+            con.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS horoscopes_fts "
+                "USING fts5(text, date UNINDEXED, sign UNINDEXED)"
+            )
+
+    def add(self, date, horoscope, path=None):
+        """Store (or replace) the horoscope of a day.
+
+        Args:
+            date (str): Day of the horoscope, as YYYY-MM-DD.
+            horoscope (dict): {sign: (star, text)} as returned by `parse_horoscope`.
+            path (str or Path): Image of the horoscope.
+        """
+        path = str(path) if path is not None else None
+        with sqlite_connection(self.path) as con:
+            con.execute("DELETE FROM horoscopes WHERE date = ?", (date,))
+            con.execute("DELETE FROM horoscopes_fts WHERE date = ?", (date,))
+            con.executemany(
+                "INSERT INTO horoscopes VALUES (?, ?, ?, ?, ?)",
+                [(date, sign, star, text, path) for sign, (star, text) in horoscope.items()],
+            )
+            con.executemany(
+                "INSERT INTO horoscopes_fts VALUES (?, ?, ?)",
+                [(text, date, sign) for sign, (_, text) in horoscope.items()],
+            )
+
+    def add_file(self, path, horoscope):
+        """Store the horoscope parsed from an image named YYYY-MM-DD.jpg. Other names are ignored.
+
+        Returns:
+            bool: Whether the horoscope was stored.
+        """
+        date = Path(path).stem
+        if not re.fullmatch(r"\d{4}-\d{2}-\d{2}", date):
+            return False
+        self.add(date, horoscope, path)
+        return True
+
+    def add_parsed(self, output):
+        """Store the horoscopes written by `rtl2_horoscope.parse.parse_many`, e.g. to index a whole folder.
+
+        Returns:
+            int: Number of horoscopes stored.
+        """
+        from rtl2_horoscope.parse import read_parsed
+
+        return sum(self.add_file(path, horoscope) for path, horoscope in read_parsed(output).items())
+
+    def latest(self):
+        """Return the (date, image path) of the most recent horoscope, or None."""
+        with sqlite_connection(self.path) as con:
+            return con.execute("SELECT date, path FROM horoscopes ORDER BY date DESC LIMIT 1").fetchone()
+
+    def by_date(self, date):
+        """Return the horoscope of a day as {sign: (star, text)}, empty if unknown."""
+        with sqlite_connection(self.path) as con:
+            rows = con.execute(
+                "SELECT sign, star, text FROM horoscopes WHERE date = ? ORDER BY rowid", (date,)
+            ).fetchall()
+        return {sign: (star, text) for sign, star, text in rows}
+
+    def history(self, sign, limit=7):
+        """Return the last `limit` (date, star, text) of a sign, most recent first."""
+        with sqlite_connection(self.path) as con:
+            return con.execute(
+                "SELECT date, star, text FROM horoscopes WHERE sign = ? ORDER BY date DESC LIMIT ?",
+                (normalize_sign(sign), limit),
+            ).fetchall()
+
+    def search(self, words, limit=10):
+        """Return the (date, sign, star, text) whose text contains all `words`, most recent first."""
+        # Quote every word, so that user input is never interpreted as FTS5 syntax
+        query = " ".join('"' + word.replace('"', '""') + '"' for word in words.split())
+        if not query:
+            return []
+        with sqlite_connection(self.path) as con:
+            return con.execute(
+                "SELECT h.date, h.sign, h.star, h.text FROM horoscopes_fts f "
+                "JOIN horoscopes h ON h.date = f.date AND h.sign = f.sign "
+                "WHERE horoscopes_fts MATCH ? ORDER BY h.date DESC LIMIT ?",
+                (query, limit),
+            ).fetchall()
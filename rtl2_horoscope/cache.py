@@ -0,0 +1,109 @@
+import json
+import time
+
+from rtl2_horoscope.ocr import default_pool
+from rtl2_horoscope.parse import REFERENCE_PATH, min_confidence, parse_horoscope
+from rtl2_horoscope.utils import md5, sqlite_connection
+
+CACHE_PATH = "horoscope_cache.sqlite"
+REGIONS_PATH = "regions.json"
+
+
+class HoroscopeCache:
+    """On-disk cache of parsed horoscopes.
+
+    Entries are keyed by the MD5 of the image, the MD5 of `regions.json` (and of the reference
+    horoscope when aligning) and the OCR settings, so editing the regions or changing the OCR
+    engine invalidates them. The least recently used entries are evicted once there are more
+    than `max_entries`.
+
+    Args:
+        path (str): SQLite database file.
+            Default: CACHE_PATH.
+        max_entries (int): Maximum number of horoscopes to keep.
+            Default: 1000.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        with sqlite_connection(self.path) as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS horoscopes ("
+                "key TEXT PRIMARY KEY, horoscope TEXT NOT NULL, last_access REAL NOT NULL)"
+            )
+
+    def key(self, filename, pool=default_pool, preprocess=False, align=True, fallback=None):
+        """Compute the cache key of an image.
+
+        Args:
+            filename (str or Path): Path to the image.
+            pool (TesseractPool): Tesseract engines used to read the image.
+                Default: default_pool.
+            preprocess (bool): Whether text crops are preprocessed before OCR.
+                Default: False.
+            align (bool): Whether images are registered on the reference horoscope.
+                Default: True.
+            fallback (OCR engine or None): Engine re-reading the blocks where Tesseract is not confident.
+                Default: None.
+
+        Returns:
+            str or None: Cache key, None if the image does not exist.
+        """
+        digest = md5(filename)
+        if digest is None:
+            return None
+        settings = f"{pool.lang}-{pool.psm}-{sorted(pool.variables.items())}-{preprocess}"
+        if align:
+            settings += f"-{md5(REFERENCE_PATH)}"
+        if fallback is not None:
+            settings += f"-{type(fallback).__name__}-{min_confidence}"
+        return f"{digest}-{md5(REGIONS_PATH)}-{settings}"
+
+    def get(self, key):
+        """Return the horoscope stored under `key`, or None."""
+        with sqlite_connection(self.path) as con:
+            row = con.execute("SELECT horoscope FROM horoscopes WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            con.execute("UPDATE horoscopes SET last_access = ? WHERE key = ?", (time.time(), key))
+
+        return {sign: tuple(value) for sign, value in json.loads(row[0]).items()}
+
+    def set(self, key, horoscope):
+        """Store a horoscope under `key` and evict the least recently used entries."""
+        with sqlite_connection(self.path) as con:
+            con.execute(
+                "INSERT OR REPLACE INTO horoscopes VALUES (?, ?, ?)",
+                (key, json.dumps(horoscope, ensure_ascii=False), time.time()),
+            )
+            con.execute(
+                "DELETE FROM horoscopes WHERE key NOT IN "
+                "(SELECT key FROM horoscopes ORDER BY last_access DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+
+    def parse_horoscope(self, filename, **kwargs):
+        """Same as `rtl2_horoscope.parse.parse_horoscope`, but only runs OCR on unknown images.
+
+        Args:
+            filename (str or Path): Path to the image.
+            kwargs: Passed to `parse_horoscope`.
+
+        Returns:
+            dict with zodiac signs as keys and (star_color, text) tuples as values.
+        """
+        key = self.key(
+            filename,
+            pool=kwargs.get("pool", default_pool),
+            preprocess=kwargs.get("preprocess", False),
+            align=kwargs.get("align", True),
+            fallback=kwargs.get("fallback"),
+        )
+        horoscope = self.get(key) if key is not None else None
+        if horoscope is None:
+            horoscope = parse_horoscope(filename, **kwargs)
+            if key is not None:
+                self.set(key, horoscope)
+
+        return horoscope
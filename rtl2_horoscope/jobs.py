@@ -0,0 +1,57 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+class JobRunner:
+    """Run blocking (OCR, classification) functions from async code without freezing the event loop.
+
+    Jobs run in an executor. Concurrent jobs submitted with the same key are only run once,
+    every caller awaiting the same result. At most `max_pending` distinct jobs can be queued or
+    running at the same time.
+
+    Args:
+        workers (int): Number of worker threads. OCR and model inference release the GIL,
+            so threads are enough to keep the event loop responsive.
+            Default: 2.
+        max_pending (int): Maximum number of distinct jobs queued or running.
+            Default: 8.
+    """
+
+    def __init__(self, workers=2, max_pending=8):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="job")
+        self.max_pending = max_pending
+        self._pending = {}
+
+    @property
+    def busy(self):
+        """Whether a new job would be rejected."""
+        return len(self._pending) >= self.max_pending
+
+    async def run(self, key, func, *args, **kwargs):
+        """Run `func(*args, **kwargs)` in the executor and return its result.
+
+        Args:
+            key (hashable): Identifies the job, e.g. the path of the image being processed.
+                If a job with the same key is already pending, its result is awaited instead.
+            func (callable): Blocking function to run.
+
+        Raises:
+            asyncio.QueueFull: if `max_pending` jobs are already pending.
+        """
+        future = self._pending.get(key)
+        if future is None:
+            if self.busy:
+                raise asyncio.QueueFull(f"{self.max_pending} jobs already pending")
+
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+            self._pending[key] = future
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+
+        # A cancelled caller must not cancel the job for the other callers
+        return await asyncio.shield(future)
+
+    def shutdown(self):
+        """Stop accepting jobs and wait for the running ones."""
+        self.executor.shutdown(wait=True)
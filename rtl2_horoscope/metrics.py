@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+
+METRICS_PATH = "metrics.prom"
+PREFIX = "horoscope"
+
+
+class Metrics:
+    """Stage timers and event counters, exported in the Prometheus text format.
+
+    Timers keep their total count and sum, and the last `window` durations for percentiles.
+
+    Args:
+        window (int): Number of recent durations kept per timer.
+            Default: 1000.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._durations = defaultdict(lambda: deque(maxlen=self.window))
+        self._sums = defaultdict(float)
+        self._counts = defaultdict(int)
+        self._counters = defaultdict(int)
+
+    def observe(self, name, seconds):
+        """Record a duration for the timer `name`."""
+        with self._lock:
+            self._durations[name].append(seconds)
+            self._sums[name] += seconds
+            self._counts[name] += 1
+
+    def inc(self, name, n=1):
+        """Increment the counter `name`."""
+        with self._lock:
+            self._counters[name] += n
+
+    @contextmanager
+    def timer(self, name):
+        """Time the enclosed block with the timer `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """Decorator timing every call of a function with the timer `name`."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def percentiles(self, name, qs=(50, 90, 99)):
+        """Percentiles of the recent durations of the timer `name`, in seconds."""
+        with self._lock:
+            durations = list(self._durations[name])
+        if not durations:
+            return {q: float("nan") for q in qs}
+        return dict(zip(qs, np.percentile(durations, qs)))
+
+    def to_prometheus(self):
+        """Export all timers (as summaries) and counters in the Prometheus text format."""
+        with self._lock:
+            timers = sorted(self._counts)
+            counters = dict(self._counters)
+
+        lines = []
+        for name in timers:
+            metric = f"{PREFIX}_{name}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for q, value in self.percentiles(name, (50, 90, 99)).items():
+                lines.append(f'{metric}{{quantile="{q/100}"}} {value}')
+            lines.append(f"{metric}_sum {self._sums[name]}")
+            lines.append(f"{metric}_count {self._counts[name]}")
+        for name, value in sorted(counters.items()):
+            metric = f"{PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=METRICS_PATH):
+        """Write `to_prometheus` to a file, e.g. for node_exporter's textfile collector."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write(self.to_prometheus())
+        # Atomic, so that the file is never read half-written
+        os.replace(tmp_path, path)
+
+    def summary(self):
+        """Human-readable table of recent percentiles (ms) and counters."""
+        with self._lock:
+            timers = sorted(self._counts)
+            counters = dict(self._counters)
+
+        lines = [f"{'étape':<24} {'n':>5} {'p50':>7} {'p90':>7} {'p99':>7}"]
+        for name in timers:
+            p = self.percentiles(name)
+            lines.append(
+                f"{name:<24} {self._counts[name]:>5} {1000*p[50]:>7.0f} {1000*p[90]:>7.0f} {1000*p[99]:>7.0f}"
+            )
+        for name, value in sorted(counters.items()):
+            lines.append(f"{name:<24} {value:>5}")
+        return "\n".join(lines)
+
+
+# Shared by the whole process
+metrics = Metrics()
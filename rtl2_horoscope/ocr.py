@@ -0,0 +1,188 @@
+import logging
+import queue
+import shlex
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pytesseract
+
+try:
+    import tesserocr
+except ImportError:
+    # Fall back to pytesseract, which spawns one tesseract process per call.
+    tesserocr = None
+
+
+# The doctr model is loaded on first use and shared by the whole process
+_ocr_model = None
+_ocr_model_lock = threading.Lock()
+
+
+def ocr_model():
+    """Return the doctr OCR predictor, loaded on first use."""
+    global _ocr_model
+    with _ocr_model_lock:
+        if _ocr_model is None:
+            # doctr pulls torch, only import it when needed
+            from doctr.models import ocr_predictor
+            logging.info("Chargement du modèle doctr")
+            _ocr_model = ocr_predictor(pretrained=True)
+    return _ocr_model
+
+
+class TesseractPool:
+    """Pool of long-lived Tesseract engines.
+
+    With `tesserocr` installed, each engine is a `PyTessBaseAPI` loaded once and kept warm:
+    images are handed over in memory, without spawning a process nor writing temp files.
+    Engines are created on demand and reused, so the pool grows to the number of threads
+    reading concurrently. Without `tesserocr`, falls back to `pytesseract`.
+
+    Args:
+        lang (str): Tesseract language.
+            Default: "fra".
+        psm (int): Tesseract page segmentation mode.
+            Default: 6 (single uniform block of text).
+        variables (dict or None): Tesseract variables to set, e.g. `tessedit_char_whitelist`.
+            Default: None.
+    """
+
+    def __init__(self, lang="fra", psm=6, variables=None):
+        self.lang = lang
+        self.psm = psm
+        self.variables = variables or {}
+        self._idle = queue.LifoQueue()
+
+    @property
+    def persistent(self):
+        """Whether engines are kept warm between calls."""
+        return tesserocr is not None
+
+    def _config(self):
+        """Command line options of the `pytesseract` fallback.
+
+        pytesseract splits them with `shlex`, so values are quoted: whitelists contain quotes.
+        """
+        return f"-l {self.lang} --psm {self.psm}" + "".join(
+            f" -c {shlex.quote(f'{name}={value}')}" for name, value in self.variables.items()
+        )
+
+    @contextmanager
+    def _engine(self):
+        try:
+            api = self._idle.get_nowait()
+        except queue.Empty:
+            api = tesserocr.PyTessBaseAPI(lang=self.lang, psm=self.psm)
+            for name, value in self.variables.items():
+                api.SetVariable(name, value)
+        try:
+            yield api
+        finally:
+            self._idle.put(api)
+
+    def image_to_string(self, img):
+        """Read the text in an image.
+
+        Args:
+            img (PIL.Image): Image to read.
+
+        Returns:
+            str: The text as read by Tesseract.
+        """
+        if not self.persistent:
+            return pytesseract.image_to_string(
+                img,
+                config=self._config(),
+            )
+
+        with self._engine() as api:
+            api.SetImage(img)
+            return api.GetUTF8Text()
+
+    def read_with_confidence(self, img):
+        """Read the text in an image, with the confidence of its least confident word.
+
+        Without `tesserocr`, the text is rebuilt from the words found by `pytesseract.image_to_data`
+        (one line per text line), so that the image is only read once.
+
+        Args:
+            img (PIL.Image): Image to read.
+
+        Returns:
+            (str, float): The text as read by Tesseract, and a confidence between 0 and 1
+                (0 when no word was found).
+        """
+        if not self.persistent:
+            data = pytesseract.image_to_data(
+                img,
+                config=self._config(),
+                output_type=pytesseract.Output.DICT,
+            )
+            lines, confidences = {}, []
+            for i, word in enumerate(data["text"]):
+                if float(data["conf"][i]) < 0 or not word.strip():
+                    continue
+                line = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+                lines.setdefault(line, []).append(word)
+                confidences.append(float(data["conf"][i]))
+            text = "\n".join(" ".join(words) for words in lines.values())
+        else:
+            with self._engine() as api:
+                api.SetImage(img)
+                text = api.GetUTF8Text()
+                confidences = api.AllWordConfidences()
+
+        return text, min(confidences, default=0) / 100
+
+    def read(self, images):
+        """Read several images one after the other, see `read_with_confidence`.
+
+        Returns:
+            list of (str, float): Text and confidence of each image.
+        """
+        return [self.read_with_confidence(img) for img in images]
+
+    def close(self):
+        """Release all idle engines."""
+        while True:
+            try:
+                api = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            api.End()
+
+
+class DoctrEngine:
+    """OCR engine reading batches of images with the (heavier) doctr model.
+
+    It has the same `read` interface as `TesseractPool`, and reads all the images given at once
+    in a single call of the model. The model is the one shared with the scraper, see `ocr_model`.
+    """
+
+    def read(self, images):
+        """Read several images in a single batch.
+
+        Args:
+            images (list of PIL.Image or np.ndarray): RGB images to read.
+
+        Returns:
+            list of (str, float): Text of each image (one line per text line), and the
+                confidence of its least confident word, between 0 and 1 (0 when no word was found).
+        """
+        if not images:
+            return []
+        result = ocr_model()([np.ascontiguousarray(img) for img in images])
+
+        out = []
+        for page in result.pages:
+            lines = [line for block in page.blocks for line in block.lines]
+            text = "\n".join(" ".join(word.value for word in line.words) for line in lines)
+            confidence = min((word.confidence for line in lines for word in line.words), default=0)
+            out.append((text, float(confidence)))
+        return out
+
+
+# Engines are only loaded on first read, so creating the shared pool is cheap.
+default_pool = TesseractPool()
+doctr_engine = DoctrEngine()
@@ -1,22 +1,32 @@
+import argparse
 import json
-from concurrent.futures import ThreadPoolExecutor
-from itertools import repeat
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 import re
 from pathlib import Path
 
-import pandas as pd
-pd.options.mode.chained_assignment = None
 import numpy as np
 from tqdm import tqdm
 
-import pytesseract
 from PIL import Image
 
+from rtl2_horoscope.align import Aligner, Transform
+from rtl2_horoscope.metrics import metrics
+from rtl2_horoscope.ocr import TesseractPool, default_pool
+
 true_width, true_height = 1181, 1716
 
 with open("regions.json", "r") as file:
     regions = json.load(file)
 
+# Horoscope which regions.json fits exactly, other images are registered on it (see Aligner)
+REFERENCE_PATH = "examples/photo103.jpg"
+aligner = Aligner(REFERENCE_PATH, (true_width, true_height))
+
 
 star_centers = {
     "bronze": [243.81, 181.88, 123.16],
@@ -26,6 +36,24 @@ star_centers = {
 
 ball_radius = 28
 
+# Text preprocessing (see preprocess_crop):
+# x-height of the text in a true_width x true_height horoscope, and the one Tesseract reads best
+template_x_height = 14
+target_x_height = 20
+# Text is black, backgrounds are white or saturated colors (red, gold): a pixel is ink when all
+# its channels are below this threshold
+ink_threshold = 128
+# Characters that clean_up_text keeps, as read by Tesseract on preprocessed crops
+char_whitelist = (
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+    "àâäçéèêëîïôöùûüÿœæÀÂÄÇÉÈÊËÎÏÔÖÙÛÜŸŒÆ"
+    " ',!?.‘’"
+)
+whitelist_pool = TesseractPool(variables={"tessedit_char_whitelist": char_whitelist})
+# With a fallback OCR engine, text blocks whose least confident word is below this confidence
+# (between 0 and 1) are read again by the fallback
+min_confidence = 0.5
+
 star_emojis = {
     "or": ":first_place:",
     "argent": ":second_place:",
@@ -51,78 +79,259 @@ def scale_regions(factor, regions=regions):
     return out
 
 
-def read_crop(img, crop_region=None, pb=None):
+@lru_cache(maxsize=16)
+def regions_for_size(width, height):
+    """Regions scaled to an image size, with integer boxes ready for cropping.
+    
+    Horoscopes are assumed to be a uniform scale of `true_width` x `true_height`.
+    Results are cached per size and shared: don't modify them.
+    
+    Args:
+        width (int): Width of the image.
+        height (int): Height of the image.
+    
+    Returns:
+        list: Regions in the format of regions.json, with tuples of ints as boxes.
+    """
+    factor = width/true_width
+    logging.debug(f"Scale factor for {width}x{height}: {factor}")
+    return regions_for_transform(Transform(factor, 0, 0))
+
+
+@lru_cache(maxsize=16)
+def regions_for_transform(transform):
+    """Regions mapped to an image by a transform, with integer boxes ready for cropping.
+    
+    Results are cached per transform and shared: don't modify them.
+    
+    Args:
+        transform (Transform): Template to image transform, e.g. from `aligner.transform`.
+    
+    Returns:
+        list: Regions in the format of regions.json, with tuples of ints as boxes.
+    """
+    return [
+        {
+            **region,
+            "star": transform.apply(region["star"]),
+            "text": transform.apply(region["text"]),
+        }
+        for region in regions
+    ]
+
+
+@metrics.timed("align")
+def align_regions(img):
+    """Regions registered on an image with `aligner`, see `regions_for_transform`.
+    
+    Args:
+        img (PIL.Image): Horoscope image.
+    
+    Returns:
+        list: Regions in the format of regions.json, with tuples of ints as boxes.
+    """
+    return regions_for_transform(aligner.transform(img))
+
+
+def crop(img, box):
+    """Crop a PIL image, or an image already decoded to a NumPy array (without copying it).
+    
+    Args:
+        img (PIL.Image or np.ndarray): Image to crop.
+        box (tuple of ints): Coordinates of the rectangle to crop (left, upper, right, lower).
+    
+    Returns:
+        Same type as `img`.
+    """
+    if isinstance(img, np.ndarray):
+        left, upper, right, lower = box
+        # Boxes of registered regions may go past the top left corner
+        return img[max(upper, 0):lower, max(left, 0):right]
+    return img.crop(box)
+
+
+def preprocess_crop(img, scale=None, threshold=ink_threshold):
+    """Binarize a text crop so that Tesseract doesn't have to: black text on a white background.
+    
+    Args:
+        img (PIL.Image or np.ndarray): RGB crop.
+        scale (float or None): Resizing factor, e.g. to reach `target_x_height`.
+            Default: None (no resizing).
+        threshold (int): A pixel is text when all its channels are below this value, which
+            also removes colored backgrounds.
+            Default: ink_threshold.
+    
+    Returns:
+        PIL.Image: Binary image (mode "L").
+    """
+    # Darkness of the brightest channel: low for black text only
+    ink = Image.fromarray(np.asarray(img).max(axis=-1))
+    if scale is not None and scale != 1:
+        ink = ink.resize((max(1, round(ink.width*scale)), max(1, round(ink.height*scale))), Image.BILINEAR)
+    
+    return Image.fromarray(np.where(np.asarray(ink) < threshold, 0, 255).astype(np.uint8))
+
+
+@metrics.timed("read_crop")
+def read_crop(img, crop_region=None, pb=None, pool=default_pool, preprocess=False, scale=None,
+              return_confidence=False):
     """Use Tesseract OCR to extract the text at given coordinates in the given image.
     
     Args:
-        img (PIL.Image): Image to read from.
+        img (PIL.Image or np.ndarray): Image to read from.
         crop_region (tuple of ints): Coordinates of the rectangle containing the text to read.
         pb (tqdm progress bar)
+        pool (TesseractPool): Tesseract engines to read with.
+            Default: default_pool.
+        preprocess (bool): Whether to binarize the crop with `preprocess_crop` first.
+            Default: False.
+        scale (float or None): Resizing factor used when preprocessing.
+            Default: None.
+        return_confidence (bool): Whether to also return the confidence of the least confident
+            word, see `TesseractPool.read_with_confidence`.
+            Default: False.
     
     Returns:
         str: The text as read by Tesseract.
+        If `return_confidence`, also a float between 0 and 1.
     """
-    if crop_region is None:
-        crop_region = (0, 0, img.width, img.height)
-    
-    crop = img.crop(crop_region)
+    if crop_region is not None:
+        img = crop(img, crop_region)
+    if preprocess:
+        img = preprocess_crop(img, scale=scale)
+    elif isinstance(img, np.ndarray):
+        img = Image.fromarray(img)
     
     # Perform OCR
-    text = pytesseract.image_to_string(
-        crop,
-        # lang="eng",
-        config=(
-            ""
-            + "-l fra "
-            # + '--tessdata-dir "C:/Program Files/Tesseract-OCR/tessdata_bkp" '
-            + "--psm 6 "
-        )
-    )
+    if return_confidence:
+        text, confidence = pool.read_with_confidence(img)
+    else:
+        text = pool.image_to_string(img)
     
     text = text.replace("\n", " ")
     
     if pb is not None:
         pb.update()
     
+    if return_confidence:
+        return text, confidence
     return text
 
 
-def read_texts(img, threads=12, regions=regions, verbose=True):
+def default_threads(pool=default_pool, n=len(regions)):
+    """Number of threads to read `n` text blocks with, safe for this machine and OCR engine.
+    
+    Args:
+        pool (TesseractPool): Tesseract engines to read with.
+            Default: default_pool.
+        n (int): Number of text blocks to read.
+            Default: number of regions.
+    
+    Returns:
+        int: One thread per block, at most one per CPU, or one per two CPUs when every read
+            spawns a (multithreaded) tesseract process.
+    """
+    cpus = os.cpu_count() or 1
+    if not pool.persistent:
+        cpus = max(1, cpus // 2)
+    return max(1, min(n, cpus))
+
+
+def read_texts(img, threads=None, regions=regions, verbose=True, pool=default_pool, preprocess=False,
+               x_height=target_x_height, fallback=None, min_confidence=min_confidence, return_timings=False):
     """Read a horoscope image and return dict of read contents.
     
     Args:
-        img (PIL.Image): Image to read.
-        threads (int or None): Number of threads to use for multithreading.
-            12 (number of text blocks to read) is empirically the fastest.
-            Default: 12.
+        img (PIL.Image or np.ndarray): Image to read.
+        threads (int or None): Number of threads to use for multithreading. `pool` keeps up to
+            this many Tesseract engines warm. If None, use `default_threads`.
+            Default: None.
         regions (list): List of regions to use.
         verbose (bool): Whether to display a progressbar.
             Default: True.
+        pool (TesseractPool): Tesseract engines to read with. Use `whitelist_pool` with
+            `preprocess` to also restrict the characters Tesseract can output.
+            Default: default_pool.
+        preprocess (bool): Whether to binarize the crops with `preprocess_crop` before OCR.
+            Default: False.
+        x_height (float or None): When preprocessing, resize crops so that the text has this
+            x-height (in pixels). None to keep the image resolution.
+            Default: target_x_height.
+        fallback (OCR engine or None): Heavier engine (e.g. `rtl2_horoscope.ocr.doctr_engine`)
+            re-reading, in a single batch, the blocks where Tesseract is not confident enough.
+            The most confident text of the two engines is kept. None to only use Tesseract.
+            Default: None.
+        min_confidence (float): Blocks whose least confident word is below this confidence
+            (between 0 and 1) are re-read by `fallback`.
+            Default: min_confidence.
+        return_timings (bool): Whether to also return the time spent reading each block.
+            Default: False.
     
     Returns:
         dict with zodiac signs as keys and text as values.
+        If `return_timings`, also a dict with zodiac signs as keys and seconds as values.
     """
     zodiac_signs = [region["name"] for region in regions]
     text_regions = [region["text"] for region in regions]
     n = len(text_regions)
     
-    pb = tqdm(total=n, desc="Reading horoscope", disable=not verbose)
+    scale = None
+    if preprocess and x_height is not None:
+        width = img.shape[1] if isinstance(img, np.ndarray) else img.width
+        scale = x_height / (template_x_height * width / true_width)
+    
+    if threads is None:
+        threads = default_threads(pool, n)
+    
+    def timed_read_crop(region):
+        start = time.perf_counter()
+        if fallback is not None:
+            text, confidence = read_crop(img, region, None, pool, preprocess, scale, return_confidence=True)
+        else:
+            text, confidence = read_crop(img, region, None, pool, preprocess, scale), None
+        return text, confidence, time.perf_counter() - start
+    
+    # Only the calling thread updates the progressbar, and only when there is one
+    pb = tqdm(total=n, desc="Reading horoscope") if verbose else None
     
     if threads > 1:
-        with ThreadPoolExecutor(threads) as pool:
-            texts = list(pool.map(
-                read_crop,
-                repeat(img, n),
-                text_regions,
-                repeat(pb, n),
-            ))
+        with ThreadPoolExecutor(threads) as executor:
+            futures = [executor.submit(timed_read_crop, reg) for reg in text_regions]
+            if pb is not None:
+                for _ in as_completed(futures):
+                    pb.update()
+            results = [future.result() for future in futures]
     
     else:
-        texts = [read_crop(img, reg, pb) for reg in text_regions]
-    
-    pb.close()
+        results = []
+        for reg in text_regions:
+            results.append(timed_read_crop(reg))
+            if pb is not None:
+                pb.update()
     
-    return dict(zip(zodiac_signs, texts))
+    if pb is not None:
+        pb.close()
+    
+    texts = [text for text, _, _ in results]
+    timings = [seconds for _, _, seconds in results]
+    
+    if fallback is not None:
+        doubtful = [i for i, (_, confidence, _) in enumerate(results) if confidence < min_confidence]
+        if doubtful:
+            start = time.perf_counter()
+            with metrics.timer("ocr_fallback"):
+                second_reads = fallback.read([crop(img, text_regions[i]) for i in doubtful])
+            metrics.inc("ocr_fallback_blocks", len(doubtful))
+            seconds = (time.perf_counter() - start) / len(doubtful)
+            for i, (text, confidence) in zip(doubtful, second_reads):
+                timings[i] += seconds
+                if confidence > results[i][1]:
+                    texts[i] = text.replace("\n", " ")
+    
+    texts = dict(zip(zodiac_signs, texts))
+    if return_timings:
+        return texts, dict(zip(zodiac_signs, timings))
+    return texts
 
 
 def clean_up_text(text):
@@ -144,68 +353,113 @@ def clean_up_text(text):
     return text
     
 
+@metrics.timed("find_star_colors")
 def find_star_colors(img, robust=True, regions=regions):
     """Parse a horoscope image and return dict of star colors.
     
+    Each star pixel is compared to every color in `star_centers` once. A color "wins" a radius
+    when it has the most pixels closer than that radius. With `robust`, every radius in
+    `range(31)` votes and the most frequent color is kept, otherwise only `ball_radius` is used.
+    
     Args:
-        img (PIL.Image): Image to read.
-        robust (bool): Whether to use a more robust algorithm. With this enabled, processing time
-            goes from 30ms to about 300ms, but errors are less frequent.
+        img (PIL.Image or np.ndarray): Image to read.
+        robust (bool): Whether to use a more robust algorithm (vote over 31 radii instead of
+            using `ball_radius` only). Both run in a few milliseconds, but errors are less
+            frequent with this enabled.
             Default: True.
         regions (list): List of regions to use.
     
     Returns:
         dict with zodiac signs as keys and text ("bronze", "argent" or "or") as values.
+    
+    Example:
+        Same colors as counting the pixels within each radius separately, on noisy stars:
+        
+        >>> rng = np.random.default_rng(0)
+        >>> centers = np.array(list(star_centers.values()))
+        >>> img = centers[rng.integers(3, size=(12*20, 20))] + rng.normal(0, 20, (12*20, 20, 3))
+        >>> img = np.clip(img, 0, 255).astype(np.uint8)
+        >>> stars = [{"name": str(i), "star": (0, 20*i, 20, 20*(i+1))} for i in range(12)]
+        >>> def per_radius(img, radii):
+        ...     colors = {}
+        ...     for star in stars:
+        ...         px = crop(img, star["star"]).reshape(-1, 3)
+        ...         d = np.mean((px[:, None, :] - centers)**2, axis=-1)**(1/2)
+        ...         votes = np.bincount([np.argmax((d < r).sum(axis=0)) for r in radii], minlength=3)
+        ...         colors[star["name"]] = min(c for c, v in zip(star_centers, votes) if v == votes.max())
+        ...     return colors
+        >>> find_star_colors(img, regions=stars) == per_radius(img, range(31))
+        True
+        >>> find_star_colors(img, robust=False, regions=stars) == per_radius(img, [ball_radius])
+        True
     """
     zodiac_signs = [region["name"] for region in regions]
     star_regions = [region["star"] for region in regions]
+    color_names = list(star_centers)
+    centers = np.array(list(star_centers.values()))
+    radii = np.arange(31) if robust else np.array([ball_radius])
+    n_signs, n_colors, n_bins = len(zodiac_signs), len(color_names), radii.max() + 1
     
-    # List containing the vector of pixels of each star region
+    # Vector of pixels of each star region, stacked into a single (pixel, 3) array
     pixels = [
-        np.array(img.crop(star)).reshape(-1, 3)
+        np.asarray(crop(img, star)).reshape(-1, 3)
         for star in star_regions
     ]
-    
-    rng = range(31) if robust else [ball_radius]
-    
-    distances = [
-        pd.DataFrame(
-            {
-                color_name: [
-                    np.mean(
-                        np.mean((px - center)**2, axis=-1)**(1/2)
-                        >= ball_radius
-                    )
-                    for px in pixels
-                ]
-                for color_name, center in star_centers.items()
-            },
-            index = zodiac_signs
-        )
-        for ball_radius in rng
-    ]
-    
-    guesses = pd.concat([df.idxmin(axis=1) for df in distances], axis=1)
-    
-    # Get min distance per row
-    colors = guesses.mode(axis=1).squeeze().to_dict()
-    
-    return colors
+    sizes = np.array([len(px) for px in pixels])
+    pixels = np.concatenate(pixels)
+    sign_idx = np.repeat(np.arange(n_signs), sizes)
+    
+    # (pixel, color) distances, computed once for all radii
+    distances = np.mean((pixels[:, None, :] - centers)**2, axis=-1)**(1/2)
+    
+    # distance < radius <=> floor(distance) < radius for integer radii, so a histogram of
+    # floor(distance) cumulated over bins gives the number of pixels within each radius.
+    bins = np.minimum(np.floor(distances), n_bins).astype(np.intp)
+    flat_idx = ((sign_idx[:, None] * n_colors + np.arange(n_colors)) * (n_bins + 1) + bins)
+    hist = np.bincount(flat_idx.ravel(), minlength=n_signs * n_colors * (n_bins + 1))
+    within = np.cumsum(hist.reshape(n_signs, n_colors, n_bins + 1), axis=-1)
+    within = np.concatenate([np.zeros((n_signs, n_colors, 1), dtype=within.dtype), within], axis=-1)
+    
+    # Best color per (sign, radius): the one with the most pixels inside the ball.
+    # argmax keeps the first color on ties.
+    guesses = within[:, :, radii].argmax(axis=1)
+    
+    # Most frequent guess per sign, ties broken by color name
+    votes = np.stack([np.bincount(g, minlength=n_colors) for g in guesses])
+    by_name = np.argsort(color_names)
+    winners = by_name[votes[:, by_name].argmax(axis=1)]
+    
+    return {sign: color_names[i] for sign, i in zip(zodiac_signs, winners)}
 
 
-def parse_horoscope(img, threads=12, verbose=True):
+@metrics.timed("parse_horoscope")
+def parse_horoscope(img, threads=None, verbose=True, pool=default_pool, preprocess=False, align=True,
+                    fallback=None, return_timings=False):
     """Parse texts and stars in a horoscope image and return info as a dict.
     
     Args:
         img (PIL.Image or str): Image to read or path to image.
         threads (int or None): Number of threads to use for reading blocks of text.
-            12 (number of text blocks to read) is empirically the fastest.
-            Default: 12.
-        verbose (bool): Whether to display a progressbar.
+            If None, use `default_threads`.
+            Default: None.
+        verbose (bool): Whether to display a progressbar. If False, nothing is written to the console.
             Default: True.
+        pool (TesseractPool): Tesseract engines to read with.
+            Default: default_pool.
+        preprocess (bool): Whether to binarize and resize text crops before OCR, see `read_texts`.
+            Default: False.
+        align (bool): Whether to register the image on the reference horoscope before cropping
+            (see `align_regions`), instead of only scaling regions from its width.
+            Default: True.
+        fallback (OCR engine or None): Engine re-reading the text blocks where Tesseract is not
+            confident, see `read_texts`.
+            Default: None.
+        return_timings (bool): Whether to also return the time spent reading each text block.
+            Default: False.
     
     Returns:
         dict with zodiac signs as keys and (star_color, text) tuples as values.
+        If `return_timings`, also a dict with zodiac signs as keys and seconds as values.
     
     Example:
         >>> parse_horoscope("examples/photo103.jpg", threads=1, verbose=False)
@@ -236,26 +490,120 @@ def parse_horoscope(img, threads=12, verbose=True):
     """
     if isinstance(img, str) or isinstance(img, Path):
         img = Image.open(img)
-    img.load()
+    if img.mode != "RGB":
+        img = img.convert("RGB")
  
-    # Rescale regions if necessary
-    factor =  img.width/true_width
-    print("scale factor:", factor)
-    if factor != 1:
-        scaled_regions = scale_regions(factor, regions)
+    # Regions mapped to the image, computed once for both stages
+    if align:
+        scaled_regions = align_regions(img)
     else:
-        scaled_regions = regions
+        scaled_regions = regions_for_size(img.width, img.height)
+
+    # Decode once, both stages crop views of the same array
+    pixels = np.asarray(img)
 
     # Read and clean up texts
-    texts = read_texts(img, threads=threads, regions=scaled_regions, verbose=verbose)
+    texts, timings = read_texts(pixels, threads=threads, regions=scaled_regions, verbose=verbose, pool=pool,
+                                preprocess=preprocess, fallback=fallback, return_timings=True)
     texts = {sign: clean_up_text(text) for sign, text in texts.items()}
 
-    stars = find_star_colors(img, regions=scaled_regions, robust=True)
+    stars = find_star_colors(pixels, regions=scaled_regions, robust=True)
  
     keys = texts.keys()
     values = zip(stars.values(), texts.values())
     out = dict(zip(keys, values))
     
+    if return_timings:
+        return out, timings
+    return out
+
+
+def _init_worker():
+    # One OCR engine per worker process: keep Tesseract itself single-threaded so that
+    # throughput scales with the number of workers.
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+
+def _parse_path(path):
+    try:
+        return path, parse_horoscope(path, threads=1, verbose=False), None
+    except Exception as e:
+        return path, None, repr(e)
+
+
+def read_parsed(output):
+    """Read the results written by `parse_many`.
+    
+    Args:
+        output (str or Path): JSONL file written by `parse_many`.
+    
+    Returns:
+        dict with image paths as keys and horoscope dicts as values.
+    """
+    parsed = {}
+    if not os.path.isfile(output):
+        return parsed
+    
+    with open(output, "r", encoding="utf8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line may be truncated if a previous run was interrupted
+                continue
+            parsed[record["path"]] = {
+                sign: tuple(value) for sign, value in record["horoscope"].items()
+            }
+    
+    return parsed
+
+
+def parse_many(paths, workers=None, output=None, verbose=True):
+    """Parse many horoscope images in parallel, one process (and OCR engine) per worker.
+    
+    Args:
+        paths (iterable of str or Path): Images to parse.
+        workers (int or None): Number of worker processes.
+            Default: number of CPUs.
+        output (str, Path or None): JSONL file where each result is appended as soon as it is
+            available. Images already in this file are skipped, so an interrupted run can be
+            resumed by calling `parse_many` again with the same arguments.
+            Default: None (results are only returned).
+        verbose (bool): Whether to display a progressbar.
+            Default: True.
+    
+    Returns:
+        dict with image paths as keys and horoscope dicts (see `parse_horoscope`) as values,
+        for the images parsed during this call. Images that could not be parsed are logged
+        and left out.
+    """
+    paths = [str(path) for path in paths]
+    if output is not None:
+        done = read_parsed(output)
+        paths = [path for path in paths if path not in done]
+    
+    workers = workers or os.cpu_count()
+    out = {}
+    
+    file = open(output, "a", encoding="utf8") if output is not None else None
+    pb = tqdm(total=len(paths), desc="Parsing horoscopes", disable=not verbose)
+    try:
+        with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+            for path, horoscope, error in pool.imap_unordered(_parse_path, paths):
+                pb.update()
+                if error is not None:
+                    logging.warning(f"Could not parse {path}: {error}")
+                    continue
+                
+                out[path] = horoscope
+                if file is not None:
+                    file.write(json.dumps({"path": path, "horoscope": horoscope}, ensure_ascii=False) + "\n")
+                    file.flush()
+    finally:
+        pb.close()
+        if file is not None:
+            file.close()
+    
     return out
 
 
@@ -280,3 +628,36 @@ def reformat_horoscope(horoscope_dict):
     message = "\n".join(bullet_points)
     
     return message
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Parse a batch of horoscope images into a JSONL file.",
+    )
+    parser.add_argument(
+        "paths", nargs="+",
+        help="Images to parse, or folders in which to parse every .jpg image.",
+    )
+    parser.add_argument(
+        "-o", "--output", default="horoscopes.jsonl",
+        help="JSONL file to append results to. Already parsed images are skipped. "
+             "Default: horoscopes.jsonl.",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=None,
+        help="Number of worker processes. Default: number of CPUs.",
+    )
+    args = parser.parse_args()
+    
+    paths = []
+    for path in map(Path, args.paths):
+        if path.is_dir():
+            paths += sorted(path.glob("*.jpg"))
+        else:
+            paths.append(path)
+    
+    parse_many(paths, workers=args.workers, output=args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import asyncio
+import datetime as dt
+import logging
+import os
+import statistics
+from typing import Awaitable, Callable, List, Optional
+
+from rtl2_horoscope.utils import now, tz_paris
+
+
+def learn_publication_time(folder: str, n: int = 30) -> Optional[dt.time]:
+    """Estimate the usual publication time from the horoscopes saved in `folder`.
+
+    Files are named YYYY-MM-DD.jpg and written as soon as the horoscope is found, so their
+    modification time is close to the publication time. Files modified on another day than
+    their name (copies, manual downloads) are ignored.
+
+    Args:
+        folder (str): folder of saved horoscopes
+        n (int): number of most recent horoscopes to use
+
+    Returns:
+        datetime.time or None: median publication time, None if unknown
+    """
+    if not os.path.isdir(folder):
+        return None
+
+    seconds = []
+    for name in sorted(os.listdir(folder), reverse=True)[:n]:
+        mtime = dt.datetime.fromtimestamp(os.path.getmtime(os.path.join(folder, name)), tz_paris)
+        if name == mtime.strftime("%Y-%m-%d") + ".jpg":
+            seconds.append(mtime.hour*3600 + mtime.minute*60 + mtime.second)
+
+    if not seconds:
+        return None
+    median = int(statistics.median(seconds))
+    return dt.time(median // 3600, median % 3600 // 60, median % 60)
+
+
+class FetchScheduler:
+    """Call `fetch` during the given windows until it succeeds, once per day.
+
+    Polls are more frequent close to the usual publication time: the interval between two polls
+    is a tenth of the time to the usual publication time, bounded by `min_interval` and
+    `max_interval`. After an error, the interval doubles (up to `max_interval`) until a poll succeeds.
+
+    Args:
+        fetch: coroutine function returning True once the horoscope of the day is found
+        days (list of int): days to fetch horoscope (0 is Monday)
+        hours (list of int): (whole) hours to fetch horoscope
+        min_interval (float): minimum number of seconds between two polls
+        max_interval (float): maximum number of seconds between two polls
+        learn_usual_time: function returning the usual publication time (datetime.time or None),
+            called when starting and after each publication
+
+    Example : FetchScheduler(fetch, [0,1,3,4], [7,8,10,12,13]):
+    Poll on Monday, Tuesday, Thursday and Friday, during hours 7, 8, 10, 12 and 13.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[], Awaitable[bool]],
+        days: List[int] = [0, 1, 2, 3, 4],
+        hours: List[int] = [9, 10, 11, 12],
+        min_interval: float = 60,
+        max_interval: float = 300,
+        learn_usual_time: Optional[Callable[[], Optional[dt.time]]] = None,
+    ):
+        assert max(days) <= 6, "Need number between 0 and 6"
+        assert min(days) >= 0, "Need number between 0 and 6"
+
+        assert max(hours) <= 23, "Need number between 0 and 23"
+        assert min(hours) >= 0, "Need number between 0 and 23"
+
+        self.fetch = fetch
+        self.days = days
+        self.hours = hours
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.learn_usual_time = learn_usual_time
+        self.usual_time = None
+        self.done_date = None
+        self._wakeup = None
+        self._stopped = False
+
+    def in_window(self, t: dt.datetime) -> bool:
+        return t.weekday() in self.days and t.hour in self.hours
+
+    def next_window(self, t: dt.datetime) -> dt.datetime:
+        """Start of the next fetch window after `t`, on another day than `done_date`.
+
+        Example:
+            >>> scheduler = FetchScheduler(None)
+            >>> friday = tz_paris.localize(dt.datetime(2021, 6, 4, 14, 30))
+            >>> print(scheduler.next_window(friday))
+            2021-06-07 09:00:00+02:00
+            >>> print(scheduler.next_window(tz_paris.localize(dt.datetime(2021, 6, 5, 10))))
+            2021-06-07 09:00:00+02:00
+            >>> print(scheduler.next_window(tz_paris.localize(dt.datetime(2021, 6, 7, 9, 30))))
+            2021-06-07 10:00:00+02:00
+
+            Once the horoscope of the day is found, the windows of the day are skipped:
+
+            >>> scheduler.done_date = dt.date(2021, 6, 7)
+            >>> print(scheduler.next_window(tz_paris.localize(dt.datetime(2021, 6, 7, 9, 30))))
+            2021-06-08 09:00:00+02:00
+        """
+        start = t.replace(minute=0, second=0, microsecond=0)
+        for k in range(1, 24*8):
+            candidate = tz_paris.normalize(start + dt.timedelta(hours=k))
+            if self.in_window(candidate) and candidate.date() != self.done_date:
+                return candidate
+        raise ValueError("Empty fetch window")
+
+    def poll_interval(self, t: dt.datetime) -> float:
+        """Number of seconds to wait before the next poll.
+
+        Example:
+            >>> scheduler = FetchScheduler(None, min_interval=60, max_interval=300)
+            >>> t = tz_paris.localize(dt.datetime(2021, 6, 7, 9, 0))
+            >>> scheduler.poll_interval(t)
+            300
+            >>> scheduler.usual_time = dt.time(10, 0)
+            >>> scheduler.poll_interval(t)
+            300
+            >>> scheduler.poll_interval(t.replace(minute=50))
+            60.0
+            >>> scheduler.poll_interval(t.replace(minute=30))
+            180.0
+        """
+        if self.usual_time is None:
+            return self.max_interval
+        usual = t.replace(
+            hour=self.usual_time.hour, minute=self.usual_time.minute,
+            second=self.usual_time.second, microsecond=0,
+        )
+        distance = abs((t - usual).total_seconds())
+        return min(max(distance / 10, self.min_interval), self.max_interval)
+
+    def mark_done(self, date: Optional[dt.date] = None):
+        """Stop polling for `date` (default: today), e.g. when the horoscope was found another way."""
+        self.done_date = date or now().date()
+        if self.learn_usual_time is not None:
+            self.usual_time = self.learn_usual_time()
+        self._wake()
+
+    def stop(self):
+        """Make `run` return as soon as possible. A poll in progress is not interrupted."""
+        self._stopped = True
+        self._wake()
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _sleep(self, seconds: float):
+        """Sleep `seconds`, or less if woken up by `mark_done` or `stop`."""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=max(seconds, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        """Poll until `stop` is called. Cancel the task running it to also interrupt a poll."""
+        self._wakeup = asyncio.Event()
+        if self.learn_usual_time is not None:
+            self.usual_time = self.learn_usual_time()
+        logging.info(f"Heure de publication habituelle : {self.usual_time}")
+
+        failures = 0
+        while not self._stopped:
+            # Wake-ups that happened before this point are taken into account by the checks below
+            self._wakeup.clear()
+            t = now()
+            if not self.in_window(t) or t.date() == self.done_date:
+                next_window = self.next_window(t)
+                logging.info(f"Reprise de l'activité le {next_window}.")
+                await self._sleep((next_window - t).total_seconds())
+                continue
+
+            try:
+                found = await self.fetch()
+                failures = 0
+            except Exception:
+                logging.exception("Erreur lors de la récupération de l'horoscope")
+                found = False
+                failures += 1
+
+            if found:
+                self.mark_done(t.date())
+            else:
+                interval = self.poll_interval(now())
+                if failures:
+                    interval = min(self.min_interval * 2**failures, self.max_interval)
+                await self._sleep(interval)
@@ -0,0 +1,35 @@
+from typing import List
+
+from rtl2_horoscope.scraper import Scraper
+
+
+class CompositeScraper(Scraper):
+    """Look for the horoscope on several social media at once.
+
+    `fetch_new_horoscope` calls the `get_last_images` of every scraper at the same time (each in
+    its own thread), checks images as soon as their source returns them, skips images already
+    found on another source (same URL or same content), and returns the first horoscope of the
+    day found. Models are shared by the whole process, so they are loaded once whatever the
+    number of scrapers.
+
+    Args:
+        scrapers (list of Scraper) : scrapers of each social media
+    """
+
+    def __init__(self, scrapers: List[Scraper]):
+        super().__init__(social_media=" + ".join(scraper.social_media for scraper in scrapers))
+        self.scrapers = scrapers
+
+    def sources(self):
+        return [source for scraper in self.scrapers for source in scraper.sources()]
+
+    def get_last_images(self, **kwargs) -> List[str]:
+        """Images hrefs of every scraper, one after the other and without duplicates"""
+        hrefs = {}
+        for scraper in self.scrapers:
+            hrefs.update(dict.fromkeys(scraper.get_last_images(**kwargs)))
+        return list(hrefs)
+
+    def close(self):
+        for scraper in self.scrapers:
+            scraper.close()
@@ -1,42 +1,158 @@
 import logging
+import queue
+import threading
+from contextlib import contextmanager
+from html.parser import HTMLParser
 
 from selenium import webdriver
-from bs4 import BeautifulSoup
+from selenium.common.exceptions import WebDriverException
 from typing import List
 
+from rtl2_horoscope.metrics import metrics
 from rtl2_horoscope.scraper import Scraper
 
 ALBUM_URL = "https://www.facebook.com/pg/rtl2/photos/?tab=album&album_id=248389291078&ref=page_internal"
 WEBDRIVER_URL = 'http://selenium-horoscope:4444/wd/hub'
 
-class FacebookScraper(Scraper):
 
-    def __init__(self, album_url: str = ALBUM_URL, webdriver_url: str = WEBDRIVER_URL):
-        super().__init__(social_media="facebook")
-        self.album_url = album_url
-        self.webdriver_url = webdriver_url
+class ImageLinkParser(HTMLParser):
+    """Collect the `src` of every `<img>` found inside an `<a>`, in order and without duplicates.
 
-    def get_last_images(self, **kwargs) -> List[str]:
+    Single pass over the page with the standard library parser, no tree is built.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.in_link = False
+        self.hrefs = {}
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            # Links can't be nested: a new <a> closes the previous one
+            self.in_link = True
+        elif tag == "img" and self.in_link:
+            src = dict(attrs).get("src")
+            if src:
+                self.hrefs[src] = None
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag == "a":
+            self.in_link = False
+
+
+def extract_image_hrefs(page_source: str) -> List[str]:
+    """Return the `src` of the images inside links of an HTML page, in order and without duplicates."""
+    parser = ImageLinkParser()
+    parser.feed(page_source)
+    parser.close()
+    return list(parser.hrefs)
+
+
+class DriverPool:
+    """Pool of long-lived remote Chrome sessions.
+
+    Sessions are checked before being handed out, and replaced when they are dead,
+    when they raised an error, or after `max_uses` uses.
+
+    Args:
+        webdriver_url (str): URL of the Selenium grid.
+        size (int): Maximum number of sessions open at the same time.
+            Default: 1.
+        max_uses (int): Number of uses after which a session is recycled.
+            Default: 50.
+    """
 
+    def __init__(self, webdriver_url: str = WEBDRIVER_URL, size: int = 1, max_uses: int = 50):
+        self.webdriver_url = webdriver_url
+        self.max_uses = max_uses
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self._uses = {}
+
+    def _create(self):
         logging.info("Initialize Webdriver")
         driver = webdriver.Remote(
             self.webdriver_url,
             options=webdriver.ChromeOptions()
         )
         driver.set_window_size(1280, 1024)
-        logging.info(f"Get {self.album_url} ...")
-        driver.get(self.album_url)
-        logging.info("Done")
-        page_source = driver.page_source
-        driver.close()
+        self._uses[driver] = 0
+        return driver
+
+    def _quit(self, driver):
+        self._uses.pop(driver, None)
+        try:
+            driver.quit()
+        except WebDriverException:
+            # Session is already dead
+            pass
+
+    @staticmethod
+    def _is_alive(driver) -> bool:
+        try:
+            driver.current_url
+            return True
+        except WebDriverException:
+            return False
+
+    @contextmanager
+    def driver(self):
+        """Borrow a healthy session from the pool."""
+        with self._slots:
+            try:
+                driver = self._idle.get_nowait()
+                if not self._is_alive(driver):
+                    logging.info("Webdriver session lost, restarting it")
+                    self._quit(driver)
+                    driver = self._create()
+            except queue.Empty:
+                driver = self._create()
+
+            try:
+                yield driver
+            except Exception:
+                self._quit(driver)
+                raise
+
+            self._uses[driver] += 1
+            if self._uses[driver] >= self.max_uses:
+                self._quit(driver)
+            else:
+                self._idle.put(driver)
+
+    def close(self):
+        """Quit all idle sessions."""
+        while True:
+            try:
+                self._quit(self._idle.get_nowait())
+            except queue.Empty:
+                break
 
-        soup = BeautifulSoup(page_source, features="html5lib")
 
-        hrefs = []
+class FacebookScraper(Scraper):
+
+    def __init__(self, album_url: str = ALBUM_URL, webdriver_url: str = WEBDRIVER_URL):
+        super().__init__(social_media="facebook")
+        self.album_url = album_url
+        self.webdriver_url = webdriver_url
+        self.drivers = DriverPool(webdriver_url)
+
+    def get_last_images(self, **kwargs) -> List[str]:
 
-        for a in soup.find_all("a"):
-            for img in a.find_all("img"):
-                hrefs.append(img['src'])
+        with metrics.timer("driver_fetch"), self.drivers.driver() as driver:
+            if driver.current_url == self.album_url:
+                logging.info(f"Refresh {self.album_url} ...")
+                driver.refresh()
+            else:
+                logging.info(f"Get {self.album_url} ...")
+                driver.get(self.album_url)
+            logging.info("Done")
+            page_source = driver.page_source
 
-        return hrefs
+        return extract_image_hrefs(page_source)
 
+    def close(self):
+        self.drivers.close()
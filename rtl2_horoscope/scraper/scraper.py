@@ -1,11 +1,15 @@
 import io
+import os
+import math
+import hashlib
 import logging
 import pickle
+import threading
 import datetime
 import aiohttp
 import asyncio
 
-from typing import Optional, List
+from typing import Callable, Optional, List, Tuple
 from collections import Counter
 from pathlib import Path
 from PIL import Image
@@ -13,7 +17,9 @@ from PIL import Image
 import numpy as np
 
 from my_constants import IMG_FOLDER
-from doctr.models import ocr_predictor
+from rtl2_horoscope.metrics import metrics
+from rtl2_horoscope.ocr import TesseractPool, ocr_model
+from rtl2_horoscope.scraper.seen import SeenImages
 from rtl2_horoscope.utils import now
 
 # top,left,bottow,right
@@ -25,6 +31,14 @@ true_occurences = Counter({1: 960179, 0: 750054, 2: 179367})
 crop_height = 800
 true_proportions = np.array([true_occurences[0], true_occurences[1], true_occurences[2]])/(true_width * crop_height)
 rtl2_header = np.array([0, 0, true_width, crop_height])
+# Maximum L1 distance between the header color proportions of a horoscope and true_proportions
+max_distance = 0.05
+# The date is written in the header, which is downsized to this width before being read
+date_width = 1024
+# Maximum number of headers read by doctr in one call
+date_batch_size = 4
+date_pool = TesseractPool()
+digits_pool = TesseractPool(variables={"tessedit_char_whitelist": "0123456789"})
 
 days = {
     "monday": "lundi",
@@ -36,27 +50,213 @@ days = {
     "sunday": "dimanche",
 }
 
-kmeans = pickle.load(open("horoscope_kmeans.pickle", "rb"))
+KMEANS_PATH = "horoscope_kmeans.pickle"
+# Cluster of each of the 2**24 RGB colors, as predicted by the KMeans model
+KMEANS_LUT_PATH = "horoscope_kmeans_lut.npy"
+
+# Models are loaded on first use and shared by all scrapers of the process (the doctr model
+# with the parser too, see rtl2_horoscope.ocr.ocr_model)
+_kmeans_lut = None
+_kmeans_lut_lock = threading.Lock()
+
+
+def build_kmeans_lut(kmeans_path=KMEANS_PATH, lut_path=KMEANS_LUT_PATH, chunk_size=1 << 20):
+    """Predict the cluster of every RGB color once and save the result as a 16 MB uint8 table.
+
+    Args:
+        kmeans_path (str) : pickled sklearn KMeans model
+        lut_path (str) : where to save the table (.npy)
+        chunk_size (int) : number of colors predicted at once
+    """
+    with open(kmeans_path, "rb") as f:
+        kmeans = pickle.load(f)
+
+    tmp_path = lut_path + ".tmp"
+    lut = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(1 << 24,))
+    for start in range(0, 1 << 24, chunk_size):
+        codes = np.arange(start, start + chunk_size)
+        rgb = np.stack([codes >> 16, (codes >> 8) & 255, codes & 255], axis=1)
+        lut[start:start + chunk_size] = kmeans.predict(rgb)
+    lut.flush()
+    del lut
+    os.replace(tmp_path, lut_path)
+
+
+def kmeans_lut():
+    """Return the color -> cluster table, memory-mapped. Built on first use if missing or outdated."""
+    global _kmeans_lut
+    with _kmeans_lut_lock:
+        if _kmeans_lut is None:
+            outdated = (
+                not os.path.isfile(KMEANS_LUT_PATH)
+                or (os.path.isfile(KMEANS_PATH) and os.path.getmtime(KMEANS_LUT_PATH) < os.path.getmtime(KMEANS_PATH))
+            )
+            if outdated:
+                logging.info(f"Construction de {KMEANS_LUT_PATH}")
+                build_kmeans_lut()
+            _kmeans_lut = np.load(KMEANS_LUT_PATH, mmap_mode="r")
+    return _kmeans_lut
+
+
+class DateChecker:
+    """Check candidates with `Scraper.are_horoscopes_of_the_day`, batching those that wait.
+
+    A candidate submitted while no batch is being read is read right away. Candidates submitted
+    meanwhile are read together in the next call (at most `batch_size` at once), so that a burst
+    of candidates pays for the model once per batch instead of once per image.
+
+    Args:
+        scraper (Scraper) : scraper whose `are_horoscopes_of_the_day` is used
+        batch_size (int) : maximum number of images per call
+    """
+
+    def __init__(self, scraper, batch_size=date_batch_size):
+        self.scraper = scraper
+        self.batch_size = batch_size
+        self._waiting = []
+        self._task = None
+
+    async def check(self, image) -> bool:
+        """Return True if `image` is today's horoscope"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((image, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return await future
+
+    async def _run(self):
+        while self._waiting:
+            # Candidates cancelled while waiting are dropped
+            waiting = [(image, future) for image, future in self._waiting if not future.done()]
+            batch, self._waiting = waiting[:self.batch_size], waiting[self.batch_size:]
+            if not batch:
+                break
+            try:
+                results = await asyncio.to_thread(
+                    self.scraper.are_horoscopes_of_the_day, [image for image, _ in batch], batch_size=self.batch_size
+                )
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                else:
+                    # Read them one by one, so that a faulty image doesn't fail the others
+                    await self._run_one_by_one(batch)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def _run_one_by_one(self, batch):
+        for image, future in batch:
+            try:
+                [result] = await asyncio.to_thread(self.scraper.are_horoscopes_of_the_day, [image], batch_size=1)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+    def cancel(self):
+        """Stop reading the candidates still waiting"""
+        if self._task is not None:
+            self._task.cancel()
 
 
 class Scraper:
 
     def __init__(self, social_media):
         self.social_media = social_media
-        self.model = ocr_predictor(pretrained=True)
+        self.seen = SeenImages()
+
+    @property
+    def model(self):
+        return ocr_model()
 
-    def is_horoscope(self, fp, verbose=False):
+    def header(self, photo, width=None):
+        """Crop the header band of a horoscope.
+
+        Args:
+            photo (PIL.Image) : horoscope
+            width (int) : if provided, downsize the header to this width
+
+        Return:
+            PIL.Image : header
+        """
+        k = photo.width/true_width
+        header = photo.crop(tuple(k*rtl2_header))
+        if width is not None and header.width > width:
+            header = header.resize((width, round(header.height*width/header.width)))
+        return header
+
+    def decode_header(self, fp, width=None):
+        """Open an image and only decode its header band.
+
+        For JPEG files, decoding stops after the last row of the header, and `Image.draft`
+        lets the decoder downscale by 2, 4 or 8 (DCT scaling) when `width` allows it.
+        Other formats are fully decoded.
+
+        Args:
+            fp (str, pathlib.Path or a file object) : image
+            width (int) : if provided, the header is decoded at the lowest resolution
+                at least this wide, and downsized to this width
+
+        Return:
+            PIL.Image : header
+        """
+        if hasattr(fp, "seek"):
+            fp.seek(0)
+        photo = Image.open(fp)
+        if width is not None and width < photo.width:
+            photo.draft("RGB", (width, round(photo.height*width/photo.width)))
+
+        header_height = min(photo.height, math.ceil(photo.width/true_width * crop_height))
+        if photo.format == "JPEG" and len(photo.tile) == 1:
+            codec, _, offset, args = photo.tile[0]
+            photo.tile = [(codec, (0, 0, photo.width, header_height), offset, args)]
+            photo._size = (photo.width, header_height)
+            try:
+                photo.load()
+            except OSError:
+                # libjpeg reports the rows left undecoded, the header itself is complete
+                pass
+
+        return self.header(photo.convert("RGB"), width=width)
+
+    def header_distance(self, photo, stride=1):
+        """L1 distance between the header color proportions of `photo` and `true_proportions`.
+
+        Args:
+            photo (PIL.Image) : image to check
+            stride (int) : only classify one pixel every `stride` rows and columns
+
+        Return:
+            float : distance to the proportions of a true horoscope
+        """
+        pixels = np.array(self.header(photo))[::stride, ::stride].reshape(-1, 3).astype(np.int32)
+        colors = (pixels[:, 0] << 16) | (pixels[:, 1] << 8) | pixels[:, 2]
+        proportions = np.bincount(kmeans_lut()[colors], minlength=3)/len(pixels)
+        return np.sum(np.abs(true_proportions - proportions))
+
+    @metrics.timed("is_horoscope")
+    def is_horoscope(self, fp, verbose=False, stride=8, margin=0.02):
         """Check if it is a horoscope or not
         Step 1 : check the picture size
-        Step 2 : use pretrained KMeans to compare color proporitons
+        Step 2 : use pretrained KMeans to compare color proporitons on a strided sample of the header
+        Step 3 : if the sample is too close to call, use every pixel of the header
 
         Args:
             fp (str, pathlib.Path or a file object) : path to horoscope
+            stride (int) : sampling step of step 2. 1 goes straight to step 3.
+            margin (float or None) : step 2 decides alone when its distance is further than `margin`
+                from `max_distance`. If None, never go to step 3.
 
         Return:
             Bool : return True if it is an horoscope, False otherwise
         """
-        # Step 1
+        # Step 1 (only reads the file headers)
+        if hasattr(fp, "seek"):
+            fp.seek(0)
         photo = Image.open(fp)
         width, height = photo.size
 
@@ -65,39 +265,207 @@ class Scraper:
             return False
         logging.info(f"Ratio de l'image correct.")
 
-        # Step 2
-        k = width/true_width
-        pixels = np.array(photo.crop(tuple(k*rtl2_header))).reshape(-1, 3)
-        occurences = Counter(kmeans.predict(pixels))
-        proportions = np.array([occurences[0], occurences[1], occurences[2]])/(k*true_width * k*crop_height)
+        # Step 2 (the header is decoded at reduced resolution, then strided if needed)
+        sample = self.decode_header(fp, width=width//stride)
+        distance = self.header_distance(sample, max(1, round(stride*sample.width/width)))
         if verbose:
-            logging.info(f"Image proportions: {proportions}")
-            logging.info(f"True proportions: {true_proportions}")
-            logging.info(f"Distance: {np.sum(np.abs(true_proportions - proportions))}")
-        return np.sum(np.abs(true_proportions - proportions)) < 0.05
+            logging.info(f"Distance (stride {stride}): {distance}")
+
+        # Step 3
+        if stride > 1 and margin is not None and abs(distance - max_distance) <= margin:
+            distance = self.header_distance(self.decode_header(fp))
+            if verbose:
+                logging.info(f"Distance: {distance}")
 
-    def is_horoscope_of_the_day(self, image) -> bool:
+        return distance < max_distance
 
-        img = np.array(Image.open(image))
-        excerpt = self.model([img]).render().lower()[:300]
+    def is_horoscope_of_the_day(self, image, region="header", engine="doctr", width=date_width) -> bool:
+        """Check if the date written on a horoscope is today
+
+        Args:
+            image (str, pathlib.Path or a file object) : path to horoscope
+            region (str) : "header" only reads the header band, downsized to `width`.
+                "full" reads the whole image.
+            engine (str) : "doctr", "tesseract" (faster), or "digits" (Tesseract restricted
+                to digits, only looks for the day number)
+            width (int) : width the header is downsized to
+
+        Return:
+            Bool : return True if today's weekday or day number is found
+        """
+        return self.are_horoscopes_of_the_day([image], region, engine, width=width)[0]
+
+    @metrics.timed("is_horoscope_of_the_day")
+    def are_horoscopes_of_the_day(self, images, region="header", engine="doctr", width=date_width,
+                                  batch_size=date_batch_size) -> List[bool]:
+        """Same as `is_horoscope_of_the_day` for several images, read by doctr in batches.
+
+        Args:
+            images (list of str, pathlib.Path or file objects) : paths to horoscopes
+            region, engine, width : see `is_horoscope_of_the_day`
+            batch_size (int) : maximum number of images per doctr call
+
+        Return:
+            List[bool] : for each image, True if today's weekday or day number is found
+        """
+        photos = []
+        for image in images:
+            if region == "header":
+                photos.append(self.decode_header(image, width=width))
+            else:
+                if hasattr(image, "seek"):
+                    image.seek(0)
+                photos.append(Image.open(image).convert("RGB"))
+
+        if engine == "doctr":
+            excerpts = []
+            for start in range(0, len(photos), batch_size):
+                batch = [np.array(photo) for photo in photos[start:start + batch_size]]
+                with metrics.timer("doctr"):
+                    excerpts += [page.render() for page in self.model(batch).pages]
+        elif engine == "tesseract":
+            excerpts = [date_pool.image_to_string(photo) for photo in photos]
+        elif engine == "digits":
+            excerpts = [digits_pool.image_to_string(photo) for photo in photos]
+        else:
+            raise ValueError(f"Unknown engine: {engine}")
 
         today = now()
         quantum = today.strftime("%d")
         day = days[today.strftime("%A").lower()]
 
-        return (day in excerpt or quantum in excerpt)
+        results = []
+        for excerpt in excerpts:
+            excerpt = excerpt.lower()[:300]
+            if engine == "digits":
+                results.append(quantum in excerpt)
+            else:
+                results.append(day in excerpt or quantum in excerpt)
+        return results
 
     def get_last_images(self, **kwargs) -> List[str]:
         """Function to get images hrefs from Social Media"""
         raise NotImplementedError
 
-    async def fetch_new_horoscope(self, img_href: Optional[str] = None, **kwargs) -> str:
+    def sources(self) -> List[Tuple[str, Callable[..., List[str]]]]:
+        """Sources of images looked at by `fetch_new_horoscope`
+
+        Return:
+            List of (name, get_last_images function) : the functions are blocking, and called
+                in threads at the same time
         """
-        1) Get last image from RTL2 social media,
-        2) check if it's a new horoscope using md5
-        3) and send the file on Discord
+        return [(self.social_media, self.get_last_images)]
+
+    def close(self):
+        """Release the resources held by the scraper"""
+        pass
+
+    async def check_image(self, img_href: str, session, downloads, classifications, use_index: bool = True,
+                          dates: Optional[DateChecker] = None, digests: Optional[set] = None):
+        """Download an image and check if it is today's horoscope.
+
+        Args:
+            img_href : URL of the image
+            session (aiohttp.ClientSession) : session to download with
+            downloads (asyncio.Semaphore) : bounds the number of concurrent downloads
+            classifications (asyncio.Semaphore) : bounds the number of concurrent classifications
+            use_index : skip images already rejected according to `self.seen`, and record the
+                verdicts there. Images accepted before are checked again.
+            dates (DateChecker) : reads the dates of horoscopes in batches with other candidates.
+                If None, the date of this image is read alone.
+            digests (set) : MD5 digests of the images already being checked by other tasks,
+                skip this image if it is one of them (it is added otherwise)
+
+        Returns:
+            io.BytesIO : the image if it is today's horoscope, None otherwise
+        """
+        metrics.inc("candidates_seen")
+        try:
+            return await self._check_image(img_href, session, downloads, classifications, use_index, dates, digests)
+        except Exception as e:
+            # e.g. not a raster image or a timeout: this candidate is lost, not the whole fetch.
+            # Not recorded in `self.seen`, the error may be transient.
+            logging.info(f"Erreur lors de la vérification de {img_href} : {e!r}")
+            metrics.inc("candidates_rejected")
+            return None
+
+    async def _check_image(self, img_href, session, downloads, classifications, use_index, dates, digests):
+        if use_index and self.seen.rejected(url=img_href) is not None:
+            logging.info(f"Image déjà rejetée : {img_href}")
+            metrics.inc("candidates_skipped")
+            return None
+
+        async with downloads:
+            try:
+                with metrics.timer("download"):
+                    image = await self.download_image(img_href, session=session)
+            except aiohttp.ClientError as e:
+                logging.info(f"Erreur lors du téléchargement de {img_href} : {e}")
+                return None
+
+        if not image:
+            # Got problem with this img_href
+            return None
+
+        digest = hashlib.md5(image.getbuffer()).hexdigest()
+        if digests is not None:
+            if digest in digests:
+                logging.info(f"Image déjà en cours de vérification : {img_href}")
+                metrics.inc("candidates_skipped")
+                return None
+            digests.add(digest)
+        rejected = self.seen.rejected(digest=digest) if use_index else None
+        if rejected is not None:
+            logging.info(f"Image déjà rejetée sous une autre URL : {img_href}")
+            metrics.inc("candidates_skipped")
+            is_horoscope, of_the_day = rejected
+            self.seen.add(img_href, digest, is_horoscope=is_horoscope, of_the_day=of_the_day)
+            return None
+
+        # Classification is CPU-bound, keep it off the event loop
+        async with classifications:
+            logging.info(f"Test de l'image {img_href}")
+            if not await asyncio.to_thread(self.is_horoscope, image, verbose=True):
+                logging.info(f"Ce n'est pas un nouveau horoscope : {img_href}")
+                metrics.inc("candidates_rejected")
+                if use_index:
+                    self.seen.add(img_href, digest, is_horoscope=False)
+                return None
+            logging.info(f"C'est un horoscope ! {img_href}")
+
+        # Outside of the classification slots, so that other candidates can join the batch
+        if dates is not None:
+            of_the_day = await dates.check(image)
+        else:
+            of_the_day = await asyncio.to_thread(self.is_horoscope_of_the_day, image)
+        if use_index:
+            self.seen.add(img_href, digest, is_horoscope=True, of_the_day=of_the_day)
+        if not of_the_day:
+            logging.info(f"Ce n'est pas l'horoscope du jour : {img_href}")
+            metrics.inc("candidates_rejected")
+            return None
+
+        metrics.inc("candidates_accepted")
+        return image
+
+    async def fetch_new_horoscope(
+        self,
+        img_href: Optional[str] = None,
+        max_downloads: int = 4,
+        max_classifications: int = 2,
+        date_batch_size: int = date_batch_size,
+        **kwargs
+    ) -> str:
+        """
+        1) Get last images from RTL2 social media (every source of `sources` at the same time),
+        2) download and check them concurrently, as soon as their source returns them
+           (dates of the horoscopes are read in batches),
+        3) save the first horoscope of the day found and cancel the remaining checks
         Args:
             img_href : if not None, download the image from <img_href> url
+            max_downloads : maximum number of images downloaded at the same time
+            max_classifications : maximum number of images classified at the same time
+            date_batch_size : maximum number of dates read in one doctr call
             kwargs: optional kwargs pass to get_last_images function
 
         Returns:
@@ -105,61 +473,95 @@ class Scraper:
         """
 
         logging.info("Fetch Horoscope")
+        user_href = bool(img_href)
+        fetches = {}
         if img_href:
             logging.info(f"Lien fourni par l'utilisateur : {img_href}.")
-            img_hrefs = [img_href]
         else:
-            logging.info(f"Récupération des dernières images depuis {self.social_media.title()}.")
-            today = now().strftime("%Y-%m-%d")
-            img_hrefs = self.get_last_images(**kwargs)
+            for name, get_last_images in self.sources():
+                logging.info(f"Récupération des dernières images depuis {name.title()}.")
+                # Selenium / twint calls are blocking
+                fetches[asyncio.ensure_future(asyncio.to_thread(get_last_images, **kwargs))] = name
 
-        if len(img_hrefs) > 0:
-            logging.info("Téléchargement des images...")
-        else:
-            logging.info("Pas d'images aujourd'hui !")
+        downloads = asyncio.Semaphore(max_downloads)
+        classifications = asyncio.Semaphore(max_classifications)
+        dates = DateChecker(self, date_batch_size)
+        # URLs and contents already being checked, the same image may come from several sources
+        checked_hrefs, digests = set(), set()
+        errors = []
+        connector = aiohttp.TCPConnector(limit=max_downloads)
+        async with aiohttp.ClientSession(connector=connector) as session:
 
-        for img_href in img_hrefs:
-            image = await self.download_image(img_href)
+            def check(img_hrefs):
+                img_hrefs = [img_href for img_href in dict.fromkeys(img_hrefs) if img_href not in checked_hrefs]
+                checked_hrefs.update(img_hrefs)
+                return {
+                    asyncio.ensure_future(self.check_image(
+                        img_href, session, downloads, classifications,
+                        # Links given by users are always checked
+                        use_index=not user_href,
+                        dates=dates,
+                        digests=digests,
+                    ))
+                    for img_href in img_hrefs
+                }
 
-            if not image:
-                # Got problem with this img_href
-                # Skip it
-                continue
+            pending = set(fetches) | check([img_href] if img_href else [])
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task in fetches:
+                            try:
+                                img_hrefs = task.result()
+                            except Exception as e:
+                                logging.info(f"Erreur lors de la récupération des images depuis {fetches[task].title()} : {e!r}")
+                                errors.append(e)
+                                continue
+                            logging.info(f"{len(img_hrefs)} images depuis {fetches[task].title()}, téléchargement...")
+                            pending |= check(img_hrefs)
+                            continue
 
-            logging.info(f"Test de l'image {img_href}")
-            if self.is_horoscope(image, verbose=True):
-                logging.info("C'est un horoscope !")
-                if self.is_horoscope_of_the_day(image):
-                    logging.info("C'est l'horoscope du jour")
-                    # Stop research
-                    filename = Path(IMG_FOLDER) / ( now().strftime("%Y-%m-%d") + ".jpg")
-                    with open(filename, "wb") as f:
-                        f.write(image.getbuffer())
-                    return filename
-                else:
-                    logging.info("Ce n'est pas l'horoscope du jour")
-            else:
-                logging.info("Ce n'est pas un nouveau horoscope")
-                # Continue research
-                await asyncio.sleep(1)
+                        image = task.result()
+                        if image:
+                            logging.info("C'est l'horoscope du jour")
+                            # Stop research
+                            filename = Path(IMG_FOLDER) / ( now().strftime("%Y-%m-%d") + ".jpg")
+                            with open(filename, "wb") as f:
+                                f.write(image.getbuffer())
+                            return filename
+            finally:
+                for task in pending:
+                    task.cancel()
+                dates.cancel()
 
+        if fetches and len(errors) == len(fetches):
+            # Every source failed
+            raise errors[0]
+        if not checked_hrefs:
+            logging.info("Pas d'images aujourd'hui !")
         return ''
 
 
-    async def download_image(self, url: str, filename: Optional[str] = None):
+    async def download_image(self, url: str, filename: Optional[str] = None, session=None):
         """Download image from `url` and save it as JPEG.
 
         Args:
             url (str) : URL to get the img
             filename (str) : if provided, save the image as `filename`.
                 Otherwise, use timestamp as filename
+            session (aiohttp.ClientSession) : if provided, download with this session.
+                Otherwise, open a new one.
 
         Return:
             Str : saved file name
         """
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as r:
-                if r.status != 200:
-                    return None
-                data = await r.read()
-                return io.BytesIO(data)
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await self.download_image(url, filename, session=session)
+
+        async with session.get(url) as r:
+            if r.status != 200:
+                return None
+            data = await r.read()
+            return io.BytesIO(data)
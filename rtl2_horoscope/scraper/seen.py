@@ -0,0 +1,98 @@
+import time
+from typing import Optional, Tuple
+
+from rtl2_horoscope.utils import now, sqlite_connection
+
+SEEN_PATH = "seen_images.sqlite"
+
+
+class SeenImages:
+    """Persistent index of the images already checked by a scraper.
+
+    Images are identified both by URL and by the MD5 of their content, since the same picture can
+    be served under several URLs. The verdicts of `is_horoscope` and `is_horoscope_of_the_day` are
+    recorded with them, with the day of the check. Only rejected images are meant to be skipped: an
+    image accepted as the horoscope of the day is checked again, e.g. when posting it failed and the
+    fetch is retried. An image that is not the horoscope of the day is only rejected on the day of
+    its check, since it may be the horoscope of the next day posted early. Entries older than `ttl`
+    seconds are forgotten, so that images are checked again from time to time.
+
+    Args:
+        path (str): SQLite database file.
+            Default: SEEN_PATH.
+        ttl (float): Number of seconds an image is remembered.
+            Default: 7 days.
+
+    >>> import os, tempfile
+    >>> seen = SeenImages(os.path.join(tempfile.mkdtemp(), "seen.sqlite"))
+    >>> seen.add("https://example.com/ad.jpg", "d0", is_horoscope=False)
+    >>> seen.rejected(url="https://example.com/ad.jpg")
+    (False, None)
+
+    An accepted image is checked again when the fetch is retried
+
+    >>> seen.add("https://example.com/today.jpg", "d1", is_horoscope=True, of_the_day=True)
+    >>> seen.rejected(url="https://example.com/today.jpg") is None
+    True
+
+    A horoscope which was not the one of the day is only rejected on the same day
+
+    >>> seen.add("https://example.com/early.jpg", "d2", is_horoscope=True, of_the_day=False, date="2021-06-01")
+    >>> seen.rejected(digest="d2", date="2021-06-01")
+    (True, False)
+    >>> seen.rejected(digest="d2", date="2021-06-02") is None
+    True
+    """
+
+    def __init__(self, path: str = SEEN_PATH, ttl: float = 7*24*3600):
+        self.path = path
+        self.ttl = ttl
+        with sqlite_connection(self.path) as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                "url TEXT PRIMARY KEY, digest TEXT, is_horoscope INTEGER, "
+                "of_the_day INTEGER, seen_at REAL NOT NULL, checked_on TEXT)"
+            )
+            # Indexes created before the day of the check was recorded
+            if "checked_on" not in [column for _, column, *_ in con.execute("PRAGMA table_info(images)")]:
+                con.execute("ALTER TABLE images ADD COLUMN checked_on TEXT")
+            con.execute("CREATE INDEX IF NOT EXISTS images_digest ON images (digest)")
+        self.evict()
+
+    def evict(self):
+        """Forget the images seen more than `ttl` seconds ago."""
+        with sqlite_connection(self.path) as con:
+            con.execute("DELETE FROM images WHERE seen_at < ?", (time.time() - self.ttl,))
+
+    def rejected(self, url: Optional[str] = None, digest: Optional[str] = None,
+                 date: Optional[str] = None) -> Optional[Tuple[bool, Optional[bool]]]:
+        """Verdicts (is_horoscope, of_the_day) of a rejected image with this URL or content digest.
+
+        Images which are not horoscopes are rejected until they are evicted, horoscopes which are
+        not the one of the day only on `date` (YYYY-MM-DD, default: today).
+        Returns None if no such image was rejected: unknown, accepted, or without verdict.
+        """
+        date = date or now().strftime("%Y-%m-%d")
+        with sqlite_connection(self.path) as con:
+            row = con.execute(
+                "SELECT is_horoscope, of_the_day FROM images "
+                "WHERE (url = ? OR digest = ?) AND (is_horoscope = 0 OR (of_the_day = 0 AND checked_on = ?)) "
+                "AND seen_at >= ?",
+                (url, digest, date, time.time() - self.ttl),
+            ).fetchone()
+        if row is None:
+            return None
+        is_horoscope, of_the_day = row
+        return bool(is_horoscope), None if of_the_day is None else bool(of_the_day)
+
+    def add(self, url: str, digest: Optional[str] = None, is_horoscope: Optional[bool] = None,
+            of_the_day: Optional[bool] = None, date: Optional[str] = None):
+        """Record a checked image and its verdicts (None if not computed), checked on `date` (default: today)."""
+        date = date or now().strftime("%Y-%m-%d")
+        with sqlite_connection(self.path) as con:
+            con.execute(
+                "INSERT OR REPLACE INTO images (url, digest, is_horoscope, of_the_day, seen_at, checked_on) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (url, digest, is_horoscope, of_the_day, time.time(), date),
+            )
+        self.evict()
@@ -3,8 +3,11 @@ import twint
 from typing import Optional, List
 
 from rtl2_horoscope.scraper import Scraper
+from rtl2_horoscope.utils import now
 
 USERNAME = "RTL2officiel"
+# Maximum number of tweets fetched per search
+LIMIT = 20
 
 class TwitterScraper(Scraper):
 
@@ -12,16 +15,24 @@ class TwitterScraper(Scraper):
         super().__init__(social_media="twitter")
         self.username = username
 
-    def get_last_images(self, since: Optional[str] = None, **kwargs) -> List[str]:
-        """Retrieve images from a twitter account"""
+    def get_last_images(self, since: Optional[str] = None, limit: int = LIMIT, **kwargs) -> List[str]:
+        """Retrieve images from a twitter account
+
+        Args:
+            since (str) : only look at tweets posted since this date (YYYY-MM-DD).
+                Default: today, the scraper is polled for today's horoscope
+            limit (int) : maximum number of tweets fetched
+        """
         c = twint.Config()
         c.Username = self.username
         c.Store_object = True
         c.Hide_output = True
+        # Never scrape the whole timeline
+        c.Since = since or now().strftime("%Y-%m-%d")
+        c.Limit = limit
 
-        if since:
-            c.Since = since
-
+        # Tweets of previous searches are kept in this module-level list
+        twint.output.tweets_list.clear()
         twint.run.Search(c)
 
         image_hrefs = []
@@ -1,9 +1,9 @@
 import hashlib
 import os
+import sqlite3
+from contextlib import closing, contextmanager
 import datetime as dt
 import pytz
-from matplotlib import pyplot as plt
-from matplotlib import patches
 from PIL import Image
 import numpy as np
 
@@ -12,7 +12,21 @@ tz_paris = pytz.timezone("Europe/Paris")
 def now():
     return dt.datetime.now().astimezone(tz_paris)
 
+@contextmanager
+def sqlite_connection(path):
+    """Connection to the SQLite database `path` for a single operation, in a transaction.
+
+    The transaction is committed on success and rolled back on error, and the connection is
+    closed on exit. One connection per operation, so the databases can be used from any thread.
+    """
+    with closing(sqlite3.connect(path)) as con, con:
+        yield con
+
 def disp_image_with_rectangle(path, coords):
+    # matplotlib is slow to import and only needed for debugging
+    from matplotlib import pyplot as plt
+    from matplotlib import patches
+
     img = np.array(Image.open(path))
     fig, ax = plt.subplots(1)
     ax.imshow(img)